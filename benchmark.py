@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+# Benchmarks always run without a window or sound card
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+from main import (Block, Fire, InputReplay, Level, Player, PhaseTimer, ScriptedInput, HEIGHT, get_mask,
+                  init_display, load_block, load_sprite_sheets, run_headless, run_right_script)
+
+SIZES = [1000, 10000, 100000]
+AGENT_COUNTS = [1, 10, 50, 100, 250, 500]
+FRAMES = 600
+BLOCK_SIZE = 96
+
+
+def generate_level(blocks, fires, seed=0):
+    # Floor along the whole level plus random platforms and fire rows, always
+    # the same for a given seed so runs can be compared
+    rng = random.Random(seed)
+    floor_length = max(blocks // 4, 20)
+    objects = [Block(i * BLOCK_SIZE, HEIGHT - BLOCK_SIZE, BLOCK_SIZE) for i in range(-5, floor_length - 5)]
+    while len(objects) < blocks:
+        x = rng.randrange(3, floor_length)
+        y = rng.randrange(2, 9)
+        for i in range(min(rng.randrange(1, 5), blocks - len(objects))):
+            objects.append(Block((x + i) * BLOCK_SIZE, HEIGHT - BLOCK_SIZE * y, BLOCK_SIZE))
+    for _ in range(fires):
+        x = rng.randrange(3 * 3, floor_length * 3)
+        objects.append(Fire(x * BLOCK_SIZE / 3, HEIGHT - BLOCK_SIZE - 64, 16, 32))
+    return objects
+
+
+def run_case(blocks, fires, frames):
+    init_display()
+    start = time.perf_counter()
+    level = Level(generate_level(blocks, fires), Player(100, 100, 50, 50, lives=frames))
+    build = time.perf_counter() - start
+    result = run_timed(level, frames, ScriptedInput(run_right_script))
+    result.update({'blocks': blocks, 'fires': fires, 'build_s': build})
+    return result
+
+
+def run_agents(agents, frames):
+    # AI characters on a generated level, all of them simulated every step
+    init_display()
+    level = Level(generate_level(1000, 100), Player(100, 100, 50, 50, lives=frames))
+    level.spawn_agents(agents)
+    result = run_timed(level, frames, ScriptedInput(run_right_script))
+    result.update({'agents': agents})
+    return result
+
+
+def run_replay(path):
+    # A session recorded with `main.py --record` as the workload
+    init_display()
+    source = InputReplay(path)
+    start = time.perf_counter()
+    level = source.level()
+    build = time.perf_counter() - start
+    result = run_timed(level, len(source), source)
+    result.update({'replay': path, 'build_s': build})
+    return result
+
+
+def run_timed(level, frames, source):
+    timer = PhaseTimer()
+    start = time.perf_counter()
+    run_headless(level, frames, source, timer)
+    elapsed = time.perf_counter() - start
+    phases = {name: {'mean_ms': mean, 'p95_ms': p95} for name, (mean, p95, _) in timer.report().items()}
+    return {'frames': frames, 'frame_ms': elapsed / frames * 1000, 'phases': phases}
+
+
+class SpriteBlock(pygame.sprite.Sprite):
+    # Block as it was stored before level objects became __slots__ records,
+    # kept as the baseline for the memory benchmark
+    def __init__(self, x, y, size):
+        super().__init__()
+        self.rect = pygame.Rect(x, y, size, size)
+        self.image = load_block(size)
+        self.width = self.height = size
+        self.name = 'none'
+        self.mask = get_mask(self.image)
+
+
+class SpriteFire(pygame.sprite.Sprite):
+    def __init__(self, x, y, width, height):
+        super().__init__()
+        self.rect = pygame.Rect(x, y, width, height)
+        self.width = width
+        self.height = height
+        self.name = 'fire'
+        self.fire = load_sprite_sheets('Traps', 'Fire', width, height)
+        self.image = self.fire['off'][0]
+        self.mask = get_mask(self.image)
+        self.animation_count = 0
+        self.animation_name = 'off'
+
+
+MEMORY_CASES = {
+    'block': lambda i: Block(i * BLOCK_SIZE, 0, BLOCK_SIZE),
+    'sprite_block': lambda i: SpriteBlock(i * BLOCK_SIZE, 0, BLOCK_SIZE),
+    'fire': lambda i: Fire(i * 32, 0, 16, 32),
+    'sprite_fire': lambda i: SpriteFire(i * 32, 0, 16, 32),
+}
+
+
+def bytes_per_entity(build, count):
+    # Python heap allocated per entity; shared surfaces and masks are built
+    # before measuring so only the entities themselves are counted
+    build(0)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    entities = [build(i) for i in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del entities
+    return used / count
+
+
+def run_memory(count):
+    init_display()
+    return {name: bytes_per_entity(build, count) for name, build in MEMORY_CASES.items()}
+
+
+def compare(results, baseline, tolerance):
+    # Names every case/metric that got slower than the baseline by more than tolerance
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None or name == 'memory':
+            continue
+        if result['frame_ms'] > old['frame_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: frame {old['frame_ms']:.3f} -> {result['frame_ms']:.3f} ms")
+        for phase, timing in result['phases'].items():
+            old_timing = old['phases'].get(phase)
+            if old_timing and timing['mean_ms'] > old_timing['mean_ms'] * (1 + tolerance):
+                regressions.append(f"{name}/{phase}: {old_timing['mean_ms']:.3f} -> {timing['mean_ms']:.3f} ms")
+    return regressions
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='Deterministic headless frame benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='block counts to benchmark')
+    parser.add_argument('--frames', type=int, default=FRAMES)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline (0.25 = 25%%)')
+    parser.add_argument('--replay', nargs='+', default=[], metavar='FILE',
+                        help='also benchmark sessions recorded with main.py --record')
+    parser.add_argument('--agents', type=int, nargs='*', metavar='COUNT',
+                        help=f'also benchmark AI agent counts (default {AGENT_COUNTS})')
+    parser.add_argument('--memory', type=int, metavar='COUNT',
+                        help='also measure bytes per entity over COUNT entities')
+    args = parser.parse_args()
+
+    results = {}
+    for blocks in args.sizes:
+        fires = blocks // 10
+        name = f'{blocks}_blocks'
+        results[name] = result = run_case(blocks, fires, args.frames)
+        print(f"{name} ({fires} fires): build {result['build_s']:.2f}s, frame {result['frame_ms']:.3f} ms")
+        for phase, timing in result['phases'].items():
+            print(f"  {phase:>10}: mean {timing['mean_ms']:.3f} ms  p95 {timing['p95_ms']:.3f} ms")
+
+    for path in args.replay:
+        name = f'replay_{os.path.splitext(os.path.basename(path))[0]}'
+        results[name] = result = run_replay(path)
+        print(f"{name} ({result['frames']} steps): frame {result['frame_ms']:.3f} ms")
+        for phase, timing in result['phases'].items():
+            print(f"  {phase:>10}: mean {timing['mean_ms']:.3f} ms  p95 {timing['p95_ms']:.3f} ms")
+
+    for agents in AGENT_COUNTS if args.agents == [] else args.agents or []:
+        name = f'{agents}_agents'
+        results[name] = result = run_agents(agents, args.frames)
+        characters = result['phases']['characters']
+        print(f"{name}: frame {result['frame_ms']:.3f} ms, characters mean {characters['mean_ms']:.3f} ms"
+              f"  p95 {characters['p95_ms']:.3f} ms")
+
+    if args.memory:
+        results['memory'] = memory = run_memory(args.memory)
+        print(f'memory ({args.memory} entities):')
+        for name, size in memory.items():
+            print(f'  {name:>12}: {size:.0f} bytes per entity')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_benchmark()
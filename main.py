@@ -1,50 +1,294 @@
+import time
+PROCESS_START = time.perf_counter()  # reference point of the startup report
+
+import io
 import os
 import sys
+import json
+from contextlib import contextmanager
+
+if '--headless' in sys.argv or '--replay' in sys.argv:
+    # No window or sound card needed, e.g. for benchmarks on CI machines
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
 import pygame
 import random
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from os.path import isfile, join
 from os import listdir
 
-pygame.init()
-pygame.mixer.init()
-pygame.mixer.set_num_channels(16)
-menu_music = pygame.mixer.Sound(join('assets', 'Music', 'Intro Theme.mp3'))
-menu_music.set_volume(0.3)
-first_level_track = pygame.mixer.Sound(join('assets', 'Music', 'Grasslands Theme.mp3'))
-first_level_track.set_volume(0.3)
-jump = pygame.mixer.Sound(join('assets', 'Music', 'jump.wav'))
-jump.set_volume(1)
-hit = pygame.mixer.Sound(join('assets', 'Music', 'hit.mp3'))
-hit.set_volume(1)
-double_jump = pygame.mixer.Sound(join('assets', 'Music', 'double_jump.wav'))
-double_jump.set_volume(1)
-four_lives = pygame.image.load(join('assets', 'Other', 'fulllife', 'h1.png'))
-three_lives = pygame.image.load(join('assets', 'Other', 'almosthalflife', 'h1.png'))
-two_lives = pygame.image.load(join('assets', 'Other', 'halflife', 'h1.png'))
-one_life = pygame.image.load(join('assets', 'Other', 'onelife', 'h1.png'))
-no_lives = pygame.image.load(join('assets', 'Other', 'death', 'death.png'))
-hearts = [no_lives, one_life, two_lives, three_lives, four_lives]
-hearts2x = [pygame.transform.scale2x(heart) for heart in hearts]
-
-
-pygame.display.set_caption('Platformer')
+# Nothing below touches the display, the sound card or the asset files at
+# import time; init_display(), init_audio() and the loaders are called when a
+# scene needs them.
+
+class StartupReport:
+    # Records how long each init phase takes between process start and the
+    # first drawn menu frame. Printed with --startup-report.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []  # (name, seconds)
+        self.first_frame = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def frame_drawn(self):
+        if self.first_frame is None:
+            self.first_frame = time.perf_counter() - PROCESS_START
+            if self.enabled:
+                print(self.format())
+
+    def format(self):
+        lines = [f'{name:>14}: {seconds * 1000:7.1f} ms' for name, seconds in self.phases]
+        lines.append(f'{"first frame":>14}: {self.first_frame * 1000:7.1f} ms after start')
+        return '\n'.join(lines)
+
+STARTUP = StartupReport('--startup-report' in sys.argv)
+STARTUP.phases.append(('imports', time.perf_counter() - PROCESS_START))
+
+RECORDING = None  # file the input of every level played is recorded to, see --record
+PLAYERS = 1  # 2 adds a second player on the same keyboard, see --players
+AGENTS = 0  # AI characters added to every level, see --agents
+
+def init_audio():
+    if not pygame.mixer.get_init():
+        pygame.mixer.init()
+        pygame.mixer.set_num_channels(16)
+
+MENU_TRACK = 'Intro Theme.mp3'
+
+
+class AudioManager:
+    # Music is streamed from disk through pygame.mixer.music, so only the
+    # playing track is decoded, a buffer at a time. The short effects are
+    # small enough to keep decoded; they are loaded on first use.
+    EFFECTS = {'jump': 'jump.wav', 'double_jump': 'double_jump.wav', 'hit': 'hit.mp3'}
+    MUSIC_VOLUME = 0.3
+    EFFECT_VOLUME = 1
+
+    def __init__(self, directory=join('assets', 'Music')):
+        self.directory = directory
+        self.effects = {}
+        self.track = None
+        self.prefetched = None  # (track, file contents) read ahead by prefetch_music()
+        self.enabled = True
+
+    def effect(self, name):
+        sound = self.effects.get(name)
+        if sound is None:
+            init_audio()
+            sound = self.effects[name] = pygame.mixer.Sound(join(self.directory, self.EFFECTS[name]))
+            sound.set_volume(self.EFFECT_VOLUME)
+        return sound
+
+    def preload_effects(self):
+        for name in self.EFFECTS:
+            self.effect(name)
+
+    def play(self, name):
+        if self.enabled:
+            self.effect(name).play()
+
+    def play_music(self, track, loops=-1):
+        # Switching tracks replaces the stream, the old track is never kept in memory
+        if track == self.track:
+            return
+        init_audio()
+        if self.prefetched and self.prefetched[0] == track:
+            pygame.mixer.music.load(io.BytesIO(self.prefetched[1]), track)
+        else:
+            pygame.mixer.music.load(join(self.directory, track))
+        self.prefetched = None
+        pygame.mixer.music.set_volume(self.MUSIC_VOLUME)
+        pygame.mixer.music.play(loops)
+        if not self.enabled:
+            pygame.mixer.music.pause()
+        self.track = track
+
+    def prefetch_music(self, track):
+        # Reads the next track into memory ahead of play_music() (safe on a
+        # worker thread), so switching to it doesn't wait on the disk
+        with open(join(self.directory, track), 'rb') as file:
+            self.prefetched = (track, file.read())
+
+    def stop_music(self):
+        if not pygame.mixer.get_init():
+            return
+        pygame.mixer.music.stop()
+        pygame.mixer.music.unload()
+        self.track = None
+
+    def pause(self):
+        if pygame.mixer.get_init():
+            pygame.mixer.pause()
+            pygame.mixer.music.pause()
+
+    def unpause(self):
+        if self.enabled and pygame.mixer.get_init():
+            pygame.mixer.unpause()
+            pygame.mixer.music.unpause()
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        if enabled:
+            self.unpause()
+        else:
+            self.pause()
+
+AUDIO = AudioManager()
 
 WIDTH = 800
 HEIGHT = 600
-FPS = 60
+FPS = 60  # simulation steps per second
+RENDER_FPS = 144  # drawing cap, independent from the simulation (0 = uncapped)
+SIM_STEP = 1000 / FPS  # milliseconds of game time per simulation step
+MAX_STEPS_PER_FRAME = 5  # catch-up limit so slow frames don't spiral
 PLAYER_SPEED = 5
 
-WINDOW = pygame.display.set_mode((WIDTH, HEIGHT))
-
-pygame.mouse.set_visible(False)  # Hide the default cursor
+WINDOW = None
+
+def init_display():
+    global WINDOW
+    if WINDOW is None:
+        pygame.display.init()
+        pygame.display.set_caption('Platformer')
+        WINDOW = pygame.display.set_mode((WIDTH, HEIGHT))
+        pygame.mouse.set_visible(False)  # Hide the default cursor
+    return WINDOW
+
+
+# Process-wide asset cache. Keys start with the source path, followed by the
+# region cut out of it and the scale factor, so every Block/Fire shares the
+# same decoded surfaces instead of hitting the disk per instance.
+ASSET_CACHE = {}
+MASK_CACHE = {}
+# Directory for the packed sprite atlas between runs (disabled when unset)
+ATLAS_CACHE_DIR = os.environ.get('PLATFORMER_ATLAS_CACHE')
+
+
+def cached_asset(key, build):
+    asset = ASSET_CACHE.get(key)
+    if asset is None:
+        asset = ASSET_CACHE[key] = build()
+    return asset
+
+def clear_asset_cache(path=None):
+    # Drop every entry loaded from `path` (a file or a directory), or everything
+    global ATLAS
+    if path is None:
+        ASSET_CACHE.clear()
+        MASK_CACHE.clear()
+        ATLAS = None
+        return
+    for key in [key for key in ASSET_CACHE if key[0] == path or key[0].startswith(join(path, ''))]:
+        for surface in iter_surfaces(ASSET_CACHE.pop(key)):
+            MASK_CACHE.pop(surface, None)
+
+def iter_surfaces(asset):
+    if isinstance(asset, pygame.Surface):
+        yield asset
+    elif isinstance(asset, dict):
+        for value in asset.values():
+            yield from iter_surfaces(value)
+    elif isinstance(asset, (list, tuple)):
+        for value in asset:
+            yield from iter_surfaces(value)
+
+def load_image(path, region=None, scale=1, alpha=True):
+    def build():
+        if region is None and scale == 1:
+            image = pygame.image.load(path)
+            return image.convert_alpha() if alpha else image.convert()
+        image = load_image(path, alpha=alpha)
+        if region is not None:
+            image = image.subsurface(region).copy()
+        if scale == 2:
+            return pygame.transform.scale2x(image)
+        if scale != 1:
+            return pygame.transform.scale(image, (image.get_width() * scale, image.get_height() * scale))
+        return image
+    return cached_asset((path, region, scale, alpha), build)
+
+PRELOAD_POOL = None
+
+def preload_pool():
+    # Worker threads shared by everything loading in the background
+    global PRELOAD_POOL
+    if PRELOAD_POOL is None:
+        PRELOAD_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    return PRELOAD_POOL
+
+class AssetPreloader:
+    # Decodes image files on a thread pool. pygame.image.load releases the GIL
+    # while decoding, so files load in parallel; poll() finishes them on the
+    # main thread (convert/convert_alpha) and stores them in the asset cache
+    # exactly where load_image() looks for them. Entries are paths, or
+    # (path, alpha) for images without transparency.
+    def __init__(self, manifest):
+        self.futures = {}
+        for entry in manifest:
+            path, alpha = (entry, True) if isinstance(entry, str) else entry
+            if (path, None, 1, alpha) not in ASSET_CACHE and (path, alpha) not in self.futures.values():
+                self.futures[preload_pool().submit(pygame.image.load, path)] = (path, alpha)
+        self.total = len(self.futures)
+
+    @property
+    def done(self):
+        return not self.futures
+
+    @property
+    def progress(self):
+        return 1 - len(self.futures) / self.total if self.total else 1
+
+    def poll(self, budget=0.004):
+        # Finishes decoded files for at most `budget` seconds
+        deadline = time.perf_counter() + budget
+        for future in [future for future in self.futures if future.done()]:
+            path, alpha = self.futures.pop(future)
+            image = future.result()
+            ASSET_CACHE[(path, None, 1, alpha)] = image.convert_alpha() if alpha else image.convert()
+            if time.perf_counter() > deadline:
+                break
+
+    def wait(self):
+        while self.futures:
+            next(iter(self.futures)).result()
+            self.poll(budget=float('inf'))
+
+def sprite_sheet_files(dir1, dir2):
+    path = join('assets', dir1, dir2)
+    return [join(path, file) for file in listdir(path) if isfile(join(path, file))]
 
+def get_mask(surface):
+    # Masks are shared between every object drawing the same surface
+    mask = MASK_CACHE.get(surface)
+    if mask is None:
+        METRICS.count('mask_builds')
+        mask = MASK_CACHE[surface] = pygame.mask.from_surface(surface)
+    return mask
 
 def flip(sprites):
     return [pygame.transform.flip(sprite, True, False) for sprite in sprites]
 
-def load_font_spritesheet(filename, scale=2):
+TEXT_DIR = join('assets', 'Menu', 'Text')
+# Sheet cells row by row, 10 to a row; spaces are empty cells
+FONT_CHARACTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ    0123456789.,:?!()+- "
+
+def font_sheet(color):
+    # The 8x10 text sheets come in White and Black
+    return join(TEXT_DIR, f'Text ({color}) (8x10).png')
+
+def build_font(filename, scale):
     # Load the entire spritesheet
-    spritesheet = pygame.image.load(filename).convert_alpha()
+    spritesheet = load_image(filename)
 
     # Dimensions of each character
     char_width = 8 * scale
@@ -54,9 +298,6 @@ def load_font_spritesheet(filename, scale=2):
     chars_per_row = 10
     rows = 5
 
-    # Mapping of characters to their ASCII values
-    characters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.:?!()+-"
-
     # Dictionary to hold the surfaces for each character
     font_dict = {}
 
@@ -69,8 +310,8 @@ def load_font_spritesheet(filename, scale=2):
 
             # Get the specific character for current position
             char_index = row * chars_per_row + col
-            if char_index < len(characters):
-                char = characters[char_index]
+            if char_index < len(FONT_CHARACTERS) and FONT_CHARACTERS[char_index] != ' ':
+                char = FONT_CHARACTERS[char_index]
                 # Create a subsurface for this character and scale it
                 char_surface = spritesheet.subsurface((x, y, 8, 10))
                 scaled_char_surface = pygame.transform.scale(char_surface, (char_width, char_height))
@@ -79,93 +320,275 @@ def load_font_spritesheet(filename, scale=2):
 
     return font_dict
 
+class BitmapFont:
+    # Renders whole strings into cached surfaces so a label costs one blit
+    # per frame and is only rendered again when its text changes. `color` is
+    # the name of a sheet ('White', 'Black') or an RGB tuple that tints the
+    # white sheet.
+    MAX_STRINGS = 128
+
+    def __init__(self, scale=2):
+        self.scale = scale
+        self.char_width = 8 * scale
+        self.char_height = 10 * scale
+        self.strings = OrderedDict()  # (text, color) -> surface, least recently used first
+
+    def glyphs(self, color):
+        filename = font_sheet(color if isinstance(color, str) else 'White')
+        return cached_asset((filename, 'font', self.scale), lambda: build_font(filename, self.scale))
+
+    def size(self, text):
+        return len(text) * self.char_width, self.char_height
+
+    def render(self, text, color='White'):
+        key = (text, color)
+        surface = self.strings.get(key)
+        if surface is not None:
+            self.strings.move_to_end(key)
+            return surface
+
+        glyphs = self.glyphs(color)
+        surface = pygame.Surface(self.size(text), pygame.SRCALPHA).convert_alpha()
+        surface.fill((0, 0, 0, 0))
+        for i, char in enumerate(text):
+            if char in glyphs:  # unknown characters are left as spaces
+                surface.blit(glyphs[char], (i * self.char_width, 0), special_flags=pygame.BLEND_RGBA_MAX)
+        if not isinstance(color, str):
+            surface.fill((*color, 255), special_flags=pygame.BLEND_RGBA_MULT)
+
+        self.strings[key] = surface
+        if len(self.strings) > self.MAX_STRINGS:
+            self.strings.popitem(last=False)
+        return surface
+
+    def blit(self, surface, text, pos, color='White'):
+        surface.blit(self.render(text, color), pos)
+
+def get_font(scale=2):
+    return cached_asset(('font', scale), lambda: BitmapFont(scale))
+
+class SpriteAtlas:
+    # Packs animation frames into a few large pages, row by row, and hands
+    # them out as subsurfaces. locate() gives the page and rect of a frame for
+    # batched (surface, dest, area) blits.
+    PAGE_SIZE = 1024
+
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+        self.pages = []
+        self.shelf = (0, 0, 0)  # x, y and height of the row being filled on the last page
+        self.sheets = {}  # sheet key -> {'signature': ..., 'frames': {name: [[page, x, y, w, h], ...]}}
+
+    def new_page(self, width, height):
+        size = (max(width, self.page_size), max(height, self.page_size))
+        self.pages.append(pygame.Surface(size, pygame.SRCALPHA).convert_alpha())
+        self.shelf = (0, 0, 0)
+
+    def pack(self, surface):
+        width, height = surface.get_size()
+        if not self.pages:
+            self.new_page(width, height)
+        x, y, row_height = self.shelf
+        if x + width > self.pages[-1].get_width():
+            x, y, row_height = 0, y + row_height, 0
+        if y + height > self.pages[-1].get_height():
+            self.new_page(width, height)
+            x, y, row_height = self.shelf
+        # The page is still transparent there, so BLEND_RGBA_MAX copies the pixels as they are
+        self.pages[-1].blit(surface, (x, y), special_flags=pygame.BLEND_RGBA_MAX)
+        self.shelf = (x + width, y, max(row_height, height))
+        return self.pages[-1].subsurface((x, y, width, height))
+
+    def locate(self, frame):
+        page = frame.get_parent()
+        return page, pygame.Rect(frame.get_offset(), frame.get_size())
+
+    def sheet(self, key, signature):
+        # Frames packed earlier (possibly in a previous run) for an unchanged sheet
+        entry = self.sheets.get(key)
+        if entry is None or entry['signature'] != signature:
+            return None
+        return {name: [self.pages[page].subsurface(rect) for page, *rect in frames]
+                for name, frames in entry['frames'].items()}
+
+    def add_sheet(self, key, signature, sprites):
+        frames = {}
+        for name, surfaces in sprites.items():
+            frames[name] = []
+            for frame in surfaces:
+                page, rect = self.locate(frame)
+                frames[name].append([self.pages.index(page), *rect])
+        self.sheets[key] = {'signature': signature, 'frames': frames}
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for i, page in enumerate(self.pages):
+            pygame.image.save(page, join(directory, f'page{i}.png'))
+        with open(join(directory, 'atlas.json'), 'w') as file:
+            json.dump({'page_size': self.page_size, 'pages': len(self.pages),
+                       'shelf': self.shelf, 'sheets': self.sheets}, file)
+
+    @classmethod
+    def load(cls, directory):
+        with open(join(directory, 'atlas.json')) as file:
+            data = json.load(file)
+        atlas = cls(data['page_size'])
+        atlas.pages = [pygame.image.load(join(directory, f'page{i}.png')).convert_alpha()
+                       for i in range(data['pages'])]
+        atlas.shelf = tuple(data['shelf'])
+        atlas.sheets = data['sheets']
+        return atlas
+
+ATLAS = None
+
+def get_atlas():
+    global ATLAS
+    if ATLAS is None:
+        ATLAS = SpriteAtlas()
+        if ATLAS_CACHE_DIR and isfile(join(ATLAS_CACHE_DIR, 'atlas.json')):
+            try:
+                ATLAS = SpriteAtlas.load(ATLAS_CACHE_DIR)
+            except (OSError, ValueError, KeyError, pygame.error):
+                pass  # a broken cache is rebuilt from the source sheets
+    return ATLAS
+
 def load_sprite_sheets(dir1, dir2, width, height, direction=False):
     path = join('assets', dir1, dir2)
+    return cached_asset((path, (width, height), 2, direction),
+                        lambda: build_sprite_sheets(path, width, height, direction))
+
+def build_sprite_sheets(path, width, height, direction):
     images  = [file for file in listdir(path) if isfile(join(path,file))]
 
-    all_sprites = {}
+    # The packed frames are reused as long as none of the source sheets changed
+    atlas = get_atlas()
+    key = f'{path}|{width}x{height}|{direction}'
+    signature = [[image, os.stat(join(path, image)).st_mtime_ns] for image in sorted(images)]
+    all_sprites = atlas.sheet(key, signature)
 
-    for image in images:
-        sprite_sheet = pygame.image.load(join(path,image)).convert_alpha()
+    if all_sprites is None:
+        all_sprites = {}
 
-        sprites =[]    
-        for i in range(sprite_sheet.get_width()//width):
-            surface = pygame.Surface((width, height), pygame.SRCALPHA, 32)
-            rect = pygame.Rect(i*width, 0, width, height)
-            surface.blit(sprite_sheet, (0,0), rect)
-            sprites.append(pygame.transform.scale2x(surface))
+        for image in images:
+            sprite_sheet = load_image(join(path, image))
 
-        if direction:
-            all_sprites[image.replace(".png", "") + "_right"] = sprites
-            all_sprites[image.replace(".png", "") + "_left"] = flip(sprites)
-        else:
-            all_sprites[image.replace(".png", '')] = sprites
+            sprites =[]    
+            for i in range(sprite_sheet.get_width()//width):
+                rect = pygame.Rect(i*width, 0, width, height)
+                sprites.append(pygame.transform.scale2x(sprite_sheet.subsurface(rect)))
+
+            if direction:
+                all_sprites[image.replace(".png", "") + "_right"] = [atlas.pack(sprite) for sprite in sprites]
+                all_sprites[image.replace(".png", "") + "_left"] = [atlas.pack(sprite) for sprite in flip(sprites)]
+            else:
+                all_sprites[image.replace(".png", '')] = [atlas.pack(sprite) for sprite in sprites]
+
+        atlas.add_sheet(key, signature, all_sprites)
+        if ATLAS_CACHE_DIR:
+            atlas.save(ATLAS_CACHE_DIR)
+
+    # Build the collision mask of every frame (and flipped frame) up front so
+    # animated objects only look them up while the game is running
+    for sprites in all_sprites.values():
+        for sprite in sprites:
+            get_mask(sprite)
 
     return all_sprites        
 
 
 
-def blit_text(surface, text, pos, font_images, char_width=16, char_height=20):  # New default sizes after scaling
-    x, y = pos
-    for char in text:
-        if char in font_images:
-            surface.blit(font_images[char], (x, y))
-            x += char_width  # Move x position by scaled character width
-        else:
-            x += char_width  # Space for unknown characters
+FONT_SHEET = font_sheet('White')
+CURSOR_IMAGE = join('assets', 'Other', 'cursor.png')
+BUTTONS_DIR = join('other_assets', 'png@0.5x', 'Buttons')
+TERRAIN_IMAGE = join('assets', 'Terrain', 'Terrain.png')
+GOAL_IMAGE = join('other_assets', 'png@0.5x', 'Star', 'Active@0.5x.png')
+# Heart bar images indexed by the number of lives left
+HEART_IMAGES = [join('assets', 'Other', *parts) for parts in
+                [('death', 'death.png'), ('onelife', 'h1.png'), ('halflife', 'h1.png'),
+                 ('almosthalflife', 'h1.png'), ('fulllife', 'h1.png')]]
+
+def load_hearts():
+    return [load_image(path, scale=2) for path in HEART_IMAGES]
 
 def load_block(size):
-    path = join('assets', 'Terrain', 'Terrain.png')
-    image = pygame.image.load(path).convert_alpha()
-    surface = pygame.Surface((size, size), pygame.SRCALPHA, 32)
-    rect = pygame.Rect(96, 0, size, size)
-    surface.blit(image, (0,0), rect)
-    return pygame.transform.scale2x(surface)
+    # The terrain tile is cut at `size` and scaled 2x, then cropped back to
+    # `size`, so every block shares one surface
+    return cached_asset((TERRAIN_IMAGE, 'block', size),
+                        lambda: load_image(TERRAIN_IMAGE, (96, 0, size, size), 2).subsurface((0, 0, size, size)))
+
+class SpriteSheets:
+    # Class attribute holding sprite sheets that are only loaded (once, through
+    # the asset cache) when first used
+    def __init__(self, *args):
+        self.args = args
+
+    def __get__(self, obj, owner):
+        return load_sprite_sheets(*self.args)
+
+# Playable characters in assets/MainCharacters; they all share one 32x32
+# frame layout, so any of them can use any body
+CHARACTERS = ('MaskDude', 'NinjaFrog', 'PinkMan', 'VirtualGuy')
+# Left, right and jump keys of each player sharing the keyboard
+PLAYER_CONTROLS = ((pygame.K_LEFT, pygame.K_RIGHT, pygame.K_SPACE), (pygame.K_a, pygame.K_d, pygame.K_w))
+
+def character_sprites(name):
+    # Loaded once per character through the asset cache and shared by every
+    # player or agent drawn with it
+    return load_sprite_sheets('MainCharacters', name, 32, 32, True)
 
 class Player(pygame.sprite.Sprite):
     GRAVITY = 1
     COLOR = (255,0,0)
-    SPRITES = load_sprite_sheets('MainCharacters', 'MaskDude', 32, 32, True)
+    SPRITES = SpriteSheets('MainCharacters', CHARACTERS[0], 32, 32, True)
     ANIMATION_DELAY = 3
     COOLDOWN_TIME = 1000
+    HITBOX = None  # see hitbox_area()
 
-    def __init__(self, x, y, width, height, lives = 4):
+    def __init__(self, x, y, width, height, lives = 4, character=CHARACTERS[0], controls=PLAYER_CONTROLS[0]):
         super().__init__()
+        self.character = character
+        self.controls = controls
+        self.sprites = character_sprites(character)
         self.rect = pygame.Rect(x, y, width, height)
+        self.prev_x = x  # position before the last simulation step, for interpolation
+        self.prev_y = y
         self.width = width
         self.height = height
         self.x_v = 0
         self.y_v = 0
         self.mask = None
         self.direction = 'left'
+        self.sprite = self.sprites['idle_left'][0]
         self.animation_count = 0
         self.fall_count = 0
         self.jump_count = 0
         self.lives = lives
         self.hit = False
         self.hit_count = 0
-        self.cool_down_timer = 0  # No cooldown initially
+        self.cool_down_timer = -self.COOLDOWN_TIME  # game time of the last hit; none yet, so no cooldown
+        self.dead = False
         
 
     def jump(self):
-        jump.play()
+        AUDIO.play('jump')
         self.y_v = -self.GRAVITY * 8
         self.animation_count = 0
         self.jump_count += 1    
         if self.jump_count == 1:
-            double_jump.play()
+            AUDIO.play('double_jump')
             self.fall_count = 0
 
     def make_hit(self, current_time):
         if current_time - self.cool_down_timer > self.COOLDOWN_TIME:
             self.lives -= 1
-            hit.play()
+            AUDIO.play('hit')
             self.cool_down_timer = current_time
             if self.lives <= 0:
                 self.die()
 
     def die(self):
-        menu(WINDOW)
+        # The scene running the level shows the game over screen
+        self.dead = True
         
 
     def move(self, dx, dy):
@@ -185,9 +608,13 @@ class Player(pygame.sprite.Sprite):
             self.direction = 'right'
             self.animation_count = 0
 
+    def save_position(self):
+        self.prev_x = self.rect.x
+        self.prev_y = self.rect.y
+
     def loop(self, fps):
+        # Only updates the velocity; handle_move() moves the player by it
         self.y_v += min(1, (self.fall_count/fps) * self.GRAVITY)
-        self.move(self.x_v, self.y_v)
 
         if self.hit:
             self.hit_count += 1
@@ -197,8 +624,11 @@ class Player(pygame.sprite.Sprite):
         self.fall_count += 1
         self.update_sprite()
 
-    def draw(self, window, offset_x, offset_y):
-        window.blit(self.sprite, (self.rect.x - offset_x, self.rect.y - offset_y))
+    def draw(self, window, offset_x, offset_y, alpha=1):
+        # alpha blends between the previous and current simulation step
+        x = self.prev_x + (self.rect.x - self.prev_x) * alpha
+        y = self.prev_y + (self.rect.y - self.prev_y) * alpha
+        window.blit(self.sprite, (x - offset_x, y - offset_y))
 
     def update_sprite(self):
         sprite_sheet = 'idle'
@@ -214,7 +644,7 @@ class Player(pygame.sprite.Sprite):
         elif self.x_v != 0:
             sprite_sheet = 'run'
         sprite_sheet_name = sprite_sheet + '_' + self.direction   
-        sprites = self.SPRITES[sprite_sheet_name]
+        sprites = self.sprites[sprite_sheet_name]
         sprite_index = (self.animation_count // self.ANIMATION_DELAY) % len(sprites)
         self.sprite = sprites[sprite_index]
         self.animation_count += 1 
@@ -244,13 +674,36 @@ class Player(pygame.sprite.Sprite):
             self.hit = False
     def update(self):
         self.rect = self.sprite.get_rect(topleft = (self.rect.x, self.rect.y))
-        self.mask = pygame.mask.from_surface(self.sprite)    
-
-class Object(pygame.sprite.Sprite):
-    def __init__(self, x, y, width, height, name = 'none'):
-        super().__init__()
+        self.mask = get_mask(self.sprite)    
+
+    @classmethod
+    def hitbox_area(cls):
+        # Part of the frame used for collisions with terrain: everything the
+        # idle animation ever covers, facing either way. Every character
+        # uses the first one's, so they all have the same body.
+        if cls.HITBOX is None:
+            rects = [rect for name in ('idle_left', 'idle_right') for frame in cls.SPRITES[name]
+                     for rect in get_mask(frame).get_bounding_rects()]
+            cls.HITBOX = rects[0].unionall(rects[1:])
+        return cls.HITBOX
+
+    def hitbox(self):
+        return self.hitbox_area().move(self.rect.topleft)
+
+class Object:
+    # Level objects are plain __slots__ records rather than pygame sprites:
+    # there are thousands of them and they never join sprite groups. Images
+    # and masks are shared between objects that look the same.
+    __slots__ = ('rect', 'image', 'mask', 'width', 'height', 'name')
+    STATIC = False
+    TILE = False  # terrain tiles on the level's grid collide through its TileMap instead of masks
+    SOLID = True  # anything else solid is tested pixel by pixel
+
+    def __init__(self, x, y, width, height, name = 'none', image = None):
         self.rect = pygame.Rect(x, y, width, height)
-        self.image = pygame.Surface((width, height), pygame.SRCALPHA)
+        if image is None:
+            image = pygame.Surface((width, height), pygame.SRCALPHA)
+        self.image = image
         self.width = width
         self.height = height
         self.name = name
@@ -259,44 +712,184 @@ class Object(pygame.sprite.Sprite):
         window.blit(self.image, (self.rect.x - offset_x, self.rect.y - offset_y))
 
 class Block(Object):
+    __slots__ = ()
+    STATIC = True
+    TILE = True
+
     def __init__(self, x, y, size):
-        super().__init__(x, y, size, size)
-        block = load_block(size)
-        self.image.blit(block, (0,0))
-        self.mask = pygame.mask.from_surface(self.image)
+        super().__init__(x, y, size, size, image=load_block(size))
+        self.mask = get_mask(self.image)
+
+def check_schedule(on_steps, off_steps):
+    # A trap's cycle has to last at least a step
+    if on_steps < 0 or off_steps < 0 or on_steps + off_steps == 0:
+        raise ValueError(f'a trap can\'t be on for {on_steps} and off for {off_steps} steps')
 
 class Fire(Object):
-    
+    # Animated by the TrapSystem of the level it is in, which picks the frame
+    # of every fire at once; image and mask are looked up from that frame.
+    # Out of a level it shows its first 'off' frame and keeps its schedule
+    # for the next TrapSystem it joins.
+    __slots__ = ('fire', 'trap', 'slot', 'timing')
     ANIMATION_DELAY = 3
 
-
     def __init__(self, x, y, width, height):
-        super().__init__(x, y, width, height, 'fire')
+        self.width = width
+        self.height = height
+        self.name = 'fire'
         self.fire = load_sprite_sheets('Traps', 'Fire', width, height)
-        self.image = self.fire['off'][0]
-        self.mask = pygame.mask.from_surface(self.image)
-        self.animation_count = 0
-        self.animation_name = 'off'
-    
+        self.rect = pygame.Rect((x, y), self.fire['off'][0].get_size())
+        self.trap = None  # TrapSystem while in a level
+        self.slot = None  # index into its arrays
+        self.timing = (1, 0, 0)  # on_steps, off_steps, phase; always on
+
+    @property
+    def image(self):
+        if self.trap is None:
+            return self.fire['off'][0]
+        return self.trap.frames[self.trap.frame[self.slot]]
+
+    @property
+    def mask(self):
+        if self.trap is None:
+            return get_mask(self.fire['off'][0])
+        return self.trap.masks[self.trap.frame[self.slot]]
+
     def on(self):
-        self.animation_name = 'on'
-    
+        self.schedule(1, 0)
+
     def off(self):
-        self.animation_name = 'off'
-    
-    def loop(self):
-        sprites = self.fire[self.animation_name]
-        sprite_index = (self.animation_count // self.ANIMATION_DELAY) % len(sprites)
-        self.image = sprites[sprite_index]
-        self.animation_count += 1 
-        self.rect = self.image.get_rect(topleft = (self.rect.x, self.rect.y))
-        self.mask = pygame.mask.from_surface(self.image)
-        if self.animation_count // self.ANIMATION_DELAY == len(sprites):
-            self.animation_count = 0
+        self.schedule(0, 1)
+
+    def schedule(self, on_steps, off_steps, phase=0):
+        check_schedule(on_steps, off_steps)
+        self.timing = (on_steps, off_steps, phase)
+        if self.trap is not None:
+            self.trap.schedule(self.slot, on_steps, off_steps, phase)
+
+class TrapSystem:
+    # Animates every trap that uses the same sprite sheets in one batched
+    # step. Counters, states and schedules live in NumPy arrays indexed by
+    # slot, frames and masks are shared and referred to by frame index.
+    # A trap is on while (step + phase) % (on_steps + off_steps) < on_steps;
+    # traps bring their schedule as `timing`, which by default keeps them
+    # on. Like the old per-object loop, a trap shows its first 'off' frame
+    # for one step before switching on.
+    def __init__(self, sheets, delay=3, capacity=64):
+        self.sheets = sheets
+        self.delay = delay
+        self.states = list(sheets)
+        self.OFF = self.states.index('off')
+        self.ON = self.states.index('on')
+        self.frames = [frame for state in self.states for frame in sheets[state]]
+        self.masks = [get_mask(frame) for frame in self.frames]
+        self.lengths = np.array([len(sheets[state]) for state in self.states])
+        self.first = np.cumsum(self.lengths) - self.lengths  # frame index of each state's first frame
+        self.steps = 0
+        self.traps = []  # slot -> trap object
+        self.counter = np.zeros(capacity, np.int64)
+        self.state = np.zeros(capacity, np.int64)
+        self.frame = np.zeros(capacity, np.int64)
+        self.phase = np.zeros(capacity, np.int64)
+        self.on_steps = np.zeros(capacity, np.int64)
+        self.off_steps = np.zeros(capacity, np.int64)
+
+    ARRAYS = ('counter', 'state', 'frame', 'phase', 'on_steps', 'off_steps')
+
+    def __len__(self):
+        return len(self.traps)
+
+    def add(self, trap):
+        slot = len(self.traps)
+        if slot == len(self.counter):
+            for name in self.ARRAYS:
+                array = getattr(self, name)
+                setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self.traps.append(trap)
+        trap.trap, trap.slot = self, slot
+        self.counter[slot] = 0
+        self.state[slot] = self.OFF
+        self.frame[slot] = self.first[self.OFF]
+        self.schedule(slot, *trap.timing)
+        trap.rect.size = self.frames[0].get_size()
+
+    def remove(self, trap):
+        # The last trap moves into the freed slot so the arrays stay dense
+        slot, last = trap.slot, len(self.traps) - 1
+        moved = self.traps.pop()
+        if moved is not trap:
+            self.traps[slot] = moved
+            moved.slot = slot
+            for name in self.ARRAYS:
+                array = getattr(self, name)
+                array[slot] = array[last]
+        trap.trap = trap.slot = None
+
+    def schedule(self, slot, on_steps, off_steps, phase=0):
+        check_schedule(on_steps, off_steps)
+        self.on_steps[slot] = on_steps
+        self.off_steps[slot] = off_steps
+        self.phase[slot] = phase
+
+    def step(self):
+        count = len(self.traps)
+        if not count:
+            return
+        counter, state, phase = self.counter[:count], self.state[:count], self.phase[:count]
+        lengths = self.lengths[state]
+        self.frame[:count] = self.first[state] + (counter + phase) // self.delay % lengths
+        counter += 1
+        counter[counter // self.delay == lengths] = 0
+
+        self.steps += 1
+        on_steps = self.on_steps[:count]
+        cycle = (self.steps + phase) % (on_steps + self.off_steps[:count])
+        state[:] = np.where(cycle < on_steps, self.ON, self.OFF)
+
+class Goal(Object):
+    # Touching it finishes the level; it stands on the floor of its cell
+    __slots__ = ()
+    SOLID = False
+
+    def __init__(self, x, y, size):
+        image = load_image(GOAL_IMAGE)
+        width, height = image.get_size()
+        super().__init__(x + (size - width) // 2, y + size - height, width, height, 'goal', image)
+
+class ObjectPool:
+    # Reuses released objects instead of allocating new ones for things that
+    # come and go all the time (streamed tiles, and later projectiles,
+    # particles and pickups). A reused object is set up again by calling its
+    # __init__ with the new arguments.
+    def __init__(self, limit=4096):
+        self.limit = limit  # free objects kept per class
+        self.free = {}  # class -> released objects
+
+    def acquire(self, cls, *args):
+        free = self.free.get(cls)
+        if not free:
+            return cls(*args)
+        obj = free.pop()
+        obj.__init__(*args)
+        return obj
+
+    def release(self, objects):
+        for obj in objects:
+            free = self.free.setdefault(type(obj), [])
+            if len(free) < self.limit:
+                free.append(obj)
+
+    def __len__(self):
+        return sum(len(free) for free in self.free.values())
+
+POOL = ObjectPool()
+
+def background_path(name):
+    return join('assets', 'Background', name)
 
 def get_bg(name):
     #load image based off its name (Blue, Brown ... whatever)
-    image = pygame.image.load(join('assets','Background', name))
+    image = load_image(background_path(name), alpha=False)
     _, _, width, height = image.get_rect()
 
     #2d list storing position of each tile
@@ -310,22 +903,437 @@ def get_bg(name):
     #returns the image and the list with all tiles needed
     return tiles, image
 
-def draw(window, bg, bg_image, player, objects, offset_x, offset_y):
-    
-
-    for tile in bg:
-        window.blit(bg_image, tile)
-
-    for obj in objects:
-        obj.draw(window, offset_x, offset_y)
-
-    player.draw(window, offset_x, offset_y)
-
-
+class SpatialGrid:
+    # Uniform grid broadphase. Every object is bucketed into the cells its rect
+    # covers, so queries only look at objects near the area asked for.
+    def __init__(self, cell_size, objects=()):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.placed = {}  # object -> (rect it was bucketed with, cell keys)
+        for obj in objects:
+            self.insert(obj)
+
+    def __len__(self):
+        return len(self.placed)
+
+    def __iter__(self):
+        return iter(self.placed)
+
+    def cell_keys(self, rect):
+        size = self.cell_size
+        return [(cx, cy)
+                for cx in range(rect.left // size, (rect.right - 1) // size + 1)
+                for cy in range(rect.top // size, (rect.bottom - 1) // size + 1)]
+
+    def insert(self, obj):
+        keys = self.cell_keys(obj.rect)
+        self.placed[obj] = (obj.rect.copy(), keys)
+        for key in keys:
+            self.cells.setdefault(key, []).append(obj)
+
+    def remove(self, obj):
+        _, keys = self.placed.pop(obj)
+        for key in keys:
+            bucket = self.cells[key]
+            bucket.remove(obj)
+            if not bucket:
+                del self.cells[key]
+
+    def update(self, obj):
+        # Re-bucket an object after it moved or changed size
+        rect, _ = self.placed[obj]
+        if rect != obj.rect:
+            self.remove(obj)
+            self.insert(obj)
+
+    def query(self, rect):
+        # Objects whose rect intersects `rect`, each returned once
+        found = {}
+        for key in self.cell_keys(rect):
+            for obj in self.cells.get(key, ()):
+                if obj not in found and rect.colliderect(obj.rect):
+                    found[obj] = None
+        return list(found)
+
+class TileMap:
+    # Solid terrain as a grid of tiles. Each cell counts the blocks on it
+    # (a level can place two on the same cell), so it reads as a boolean
+    # grid where nonzero is solid. Sweeps only look at the tiles a moving
+    # rect passes over, however fast it goes.
+    def __init__(self, tile_size):
+        self.tile_size = tile_size
+        self.offset = None  # pixel offset of the grid, taken from the first tile
+        self.first_col = self.first_row = 0  # tile coordinates of solid[0, 0]
+        self.solid = np.zeros((0, 0), np.uint8)
+
+    def fits(self, rect):
+        # Whether `rect` is a cell of the grid. Blocks placed off the grid,
+        # or of another size, are left to the pixel tests like hazards.
+        size = self.tile_size
+        if rect.size != (size, size):
+            return False
+        if self.offset is None:
+            return True
+        ox, oy = self.offset
+        return not (rect.x - ox) % size and not (rect.y - oy) % size
+
+    def handles(self, obj):
+        return obj.TILE and self.fits(obj.rect)
+
+    def cell(self, rect):
+        size = self.tile_size
+        if self.offset is None:
+            self.offset = (rect.x % size, rect.y % size)
+        ox, oy = self.offset
+        if rect.size != (size, size) or (rect.x - ox) % size or (rect.y - oy) % size:
+            raise ValueError(f'{rect} is not a cell of the {size}px tile grid')
+        return (rect.x - ox) // size, (rect.y - oy) // size
+
+    def grow(self, col, row):
+        rows, cols = self.solid.shape
+        if self.first_col <= col < self.first_col + cols and self.first_row <= row < self.first_row + rows:
+            return
+        # Grows by a margin so a streamed level doesn't copy on every chunk
+        margin = 16
+        if not self.solid.size:
+            self.first_col, self.first_row, cols, rows = col, row, 1, 1
+        first_col = min(self.first_col, col - margin) if col < self.first_col else self.first_col
+        first_row = min(self.first_row, row - margin) if row < self.first_row else self.first_row
+        last_col = max(self.first_col + cols, col + margin + 1) if col >= self.first_col + cols else self.first_col + cols
+        last_row = max(self.first_row + rows, row + margin + 1) if row >= self.first_row + rows else self.first_row + rows
+        solid = np.zeros((last_row - first_row, last_col - first_col), np.uint8)
+        if self.solid.size:
+            y, x = self.first_row - first_row, self.first_col - first_col
+            solid[y:y + self.solid.shape[0], x:x + self.solid.shape[1]] = self.solid
+        self.solid, self.first_col, self.first_row = solid, first_col, first_row
+
+    def add(self, rect):
+        col, row = self.cell(rect)
+        self.grow(col, row)
+        self.solid[row - self.first_row, col - self.first_col] += 1
+
+    def remove(self, rect):
+        col, row = self.cell(rect)
+        self.solid[row - self.first_row, col - self.first_col] -= 1
+
+    def blocked(self, first_col, last_col, first_row, last_row):
+        # Whether any tile in the inclusive column/row ranges is solid
+        METRICS.count('collision_tests')
+        # (a rect only spans a couple of tiles, so reading cells one by one
+        # is cheaper than slicing the array)
+        solid = self.solid
+        rows, cols = solid.shape
+        for row in range(max(first_row - self.first_row, 0), min(last_row - self.first_row + 1, rows)):
+            for col in range(max(first_col - self.first_col, 0), min(last_col - self.first_col + 1, cols)):
+                if solid.item(row, col):
+                    return True
+        return False
+
+    def sweep_x(self, rect, dx):
+        # How far `rect` can move by dx before it runs into a solid tile,
+        # and whether it did
+        if not dx or self.offset is None:
+            return dx, False
+        size, (ox, oy) = self.tile_size, self.offset
+        first_row, last_row = (rect.top - oy) // size, (rect.bottom - 1 - oy) // size
+        if dx > 0:
+            for col in range((rect.right - ox) // size, (rect.right - 1 + dx - ox) // size + 1):
+                if self.blocked(col, col, first_row, last_row):
+                    return min(dx, col * size + ox - rect.right), True
+        else:
+            for col in range((rect.left - 1 - ox) // size, (rect.left + dx - ox) // size - 1, -1):
+                if self.blocked(col, col, first_row, last_row):
+                    return max(dx, (col + 1) * size + ox - rect.left), True
+        return dx, False
+
+    def sweep_y(self, rect, dy):
+        if not dy or self.offset is None:
+            return dy, False
+        size, (ox, oy) = self.tile_size, self.offset
+        first_col, last_col = (rect.left - ox) // size, (rect.right - 1 - ox) // size
+        if dy > 0:
+            for row in range((rect.bottom - oy) // size, (rect.bottom - 1 + dy - oy) // size + 1):
+                if self.blocked(first_col, last_col, row, row):
+                    return min(dy, row * size + oy - rect.bottom), True
+        else:
+            for row in range((rect.top - 1 - oy) // size, (rect.top + dy - oy) // size - 1, -1):
+                if self.blocked(first_col, last_col, row, row):
+                    return max(dy, (row + 1) * size + oy - rect.top), True
+        return dy, False
+
+    def solid_at(self, cols, rows):
+        # Whether each (col, row) tile of two arrays is solid, outside the grid is empty
+        METRICS.count('collision_tests', len(cols))
+        cols, rows = cols - self.first_col, rows - self.first_row
+        height, width = self.solid.shape
+        inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+        found = np.zeros(len(cols), bool)
+        found[inside] = self.solid[rows[inside], cols[inside]] > 0
+        return found
+
+    def sweep_many(self, left, top, width, height, delta, axis):
+        # sweep_x() (axis 0) or sweep_y() (axis 1) for many rects at once:
+        # `left`, `top` and `delta` are arrays, the size is shared. All rects
+        # test their next line of tiles together, so the loop runs once per
+        # tile crossed by the fastest rect rather than once per rect.
+        delta = delta.copy()
+        hit = np.zeros(len(delta), bool)
+        if self.offset is None or not len(delta):
+            return delta, hit
+        size = self.tile_size
+        start, extent, cross, cross_extent = (left, width, top, height) if axis == 0 else (top, height, left, width)
+        origin, cross_origin = self.offset[axis], self.offset[1 - axis]
+        first_cross = (cross - cross_origin) // size
+        last_cross = (cross + cross_extent - 1 - cross_origin) // size
+        end = start + extent
+        forward = delta > 0
+        step = np.where(forward, 1, -1)
+        first = np.where(forward, (end - origin) // size, (start - 1 - origin) // size)
+        last = np.where(forward, (end - 1 + delta - origin) // size, (start + delta - origin) // size)
+        count = np.where(delta == 0, 0, np.maximum((last - first) * step + 1, 0))
+        for k in range(int(count.max(initial=0))):
+            moving = np.flatnonzero((k < count) & ~hit)
+            line = first[moving] + k * step[moving]
+            blocked = np.zeros(len(moving), bool)
+            for offset in range(int((last_cross - first_cross).max()) + 1):
+                lines = first_cross[moving] + offset
+                cells = self.solid_at(line, lines) if axis == 0 else self.solid_at(lines, line)
+                blocked |= cells & (lines <= last_cross[moving])
+            moving, line = moving[blocked], line[blocked]
+            delta[moving] = np.where(forward[moving],
+                                     np.minimum(delta[moving], line * size + origin - end[moving]),
+                                     np.maximum(delta[moving], (line + 1) * size + origin - start[moving]))
+            hit[moving] = True
+        return delta, hit
+
+# Draw order of a frame, lowest first
+LAYER_BACKGROUND, LAYER_WORLD, LAYER_PLAYER, LAYER_HUD, LAYER_CURSOR = range(5)
+
+class RenderQueue:
+    # Collects every blit of a frame and submits them in a single Surface.blits
+    # call, ordered by layer. It has a blit() like a Surface so draw methods
+    # can target it directly. flush() returns the screen areas that changed
+    # since the previous frame, for pygame.display.update(rects).
+    MAX_DIRTY_RECTS = 32
+
+    def __init__(self, target):
+        self.target = target
+        self.screen = target.get_rect()
+        self.layers = {}
+        self.layer = LAYER_WORLD
+        self.previous = set()
+        self.full_update = True
+
+    def blit(self, surface, dest, area=None, special_flags=0, layer=None):
+        self.layers.setdefault(self.layer if layer is None else layer, []).append(
+            (surface, dest, area, special_flags))
+
+    def invalidate(self):
+        # Present the whole screen next frame, e.g. after a scene change
+        self.full_update = True
+
+    def flush(self):
+        items = [item for layer in sorted(self.layers) for item in self.layers[layer]]
+        self.layers = {}
+        METRICS.count('blits', len(items))
+        self.target.blits(items, doreturn=False)
+
+        # Pixels only changed where something appeared or disappeared since
+        # the last frame, everything else was redrawn identically
+        current = {(surface, int(dest[0]), int(dest[1]), area and tuple(area), flags)
+                   for surface, dest, area, flags in items}
+        changed = current ^ self.previous
+        self.previous = current
+        if self.full_update:
+            self.full_update = False
+            return [self.screen]
+        rects = []
+        for surface, x, y, area, _ in changed:
+            size = area[2:] if area else surface.get_size()
+            rect = self.screen.clip((x, y, *size))
+            if rect:
+                rects.append(rect)
+        if len(rects) > self.MAX_DIRTY_RECTS:
+            return [self.screen]
+        return rects
+
+class Renderer:
+    # Draws only what the camera can see. Static objects are pre-rendered into
+    # one cached surface per screen-sized chunk, dynamic objects are culled
+    # against the camera rect through the spatial grid.
+    MAX_CHUNKS = 64
+
+    def __init__(self, grid, backgrounds=(), chunk_width=WIDTH, chunk_height=HEIGHT):
+        self.grid = grid
+        self.backgrounds = backgrounds  # ParallaxLayers, farthest first
+        self.chunk_width = chunk_width
+        self.chunk_height = chunk_height
+        self.chunks = OrderedDict()  # (cx, cy) -> (surface, position) or None when empty
+
+    def chunk(self, key):
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        cx, cy = key
+        area = pygame.Rect(cx * self.chunk_width, cy * self.chunk_height, self.chunk_width, self.chunk_height)
+        statics = [obj for obj in self.grid.query(area) if obj.STATIC]
+        entry = None
+        if statics:
+            bounds = statics[0].rect.unionall([obj.rect for obj in statics[1:]]).clip(area)
+            surface = pygame.Surface(bounds.size, pygame.SRCALPHA).convert_alpha()
+            METRICS.count('blits', len(statics))
+            surface.blits([(obj.image, (obj.rect.x - bounds.x, obj.rect.y - bounds.y)) for obj in statics],
+                          doreturn=False)
+            entry = (surface, bounds.topleft)
+        self.chunks[key] = entry
+        if len(self.chunks) > self.MAX_CHUNKS:
+            self.chunks.popitem(last=False)
+        return entry
+
+    def chunk_keys(self, view):
+        # Chunks `view` overlaps
+        return [(cx, cy)
+                for cx in range(view.left // self.chunk_width, (view.right - 1) // self.chunk_width + 1)
+                for cy in range(view.top // self.chunk_height, (view.bottom - 1) // self.chunk_height + 1)]
+
+    def invalidate(self, rect=None):
+        # Forget pre-rendered chunks touching `rect` (all of them by default)
+        if rect is None:
+            self.chunks.clear()
+            return
+        for key in [key for key in self.chunks if rect.colliderect(
+                (key[0] * self.chunk_width, key[1] * self.chunk_height, self.chunk_width, self.chunk_height))]:
+            del self.chunks[key]
+
+    def draw(self, window, players, view, alpha=1, characters=None):
+        # `view` is the world area on screen, see Camera.visible_rect()
+        offset_x, offset_y = view.topleft
+        for background in self.backgrounds:
+            background.draw(window, offset_x, offset_y)
+
+        for key in self.chunk_keys(view):
+            entry = self.chunk(key)
+            if entry:
+                surface, (x, y) = entry
+                window.blit(surface, (x - offset_x, y - offset_y))
+
+        for obj in self.grid.query(view):
+            if not obj.STATIC:
+                obj.draw(window, offset_x, offset_y)
+
+        window.layer = LAYER_PLAYER
+        if characters:
+            characters.draw(window, offset_x, offset_y, alpha)
+        for player in players:
+            player.draw(window, offset_x, offset_y, alpha)
+
+class ParallaxLayer:
+    # A tiled background scrolling at `factor` times the camera speed (0
+    # stands still). The tiles are flattened into one surface a tile larger
+    # than the screen, so a frame is a single blit of it at an offset.
+    def __init__(self, name, factor=0.5):
+        self.factor = factor
+        self.image = cached_asset((background_path(name), 'parallax', (WIDTH, HEIGHT)), lambda: self.build(name))
+        self.tile_width = self.image.get_width() - WIDTH
+        self.tile_height = self.image.get_height() - HEIGHT
+
+    @staticmethod
+    def build(name):
+        _, tile = get_bg(name)
+        width, height = tile.get_size()
+        image = pygame.Surface((WIDTH + width, HEIGHT + height)).convert()
+        for x in range(0, image.get_width(), width):
+            for y in range(0, image.get_height(), height):
+                image.blit(tile, (x, y))
+        return image
 
-def handle_vertical_collision(player, objects, dy):
+    def draw(self, window, offset_x, offset_y):
+        x = int(offset_x * self.factor) % self.tile_width
+        y = int(offset_y * self.factor) % self.tile_height
+        window.blit(self.image, (-x, -y), layer=LAYER_BACKGROUND)
+
+class Camera:
+    # Which part of the world is on screen. In 'dead_zone' mode it only
+    # scrolls while the target moves out of the middle of the screen, in
+    # 'smooth' mode it eases towards centring the targets by `smoothing` per
+    # step. Every target is kept on screen, the first one over the others
+    # when they are too far apart. The position is kept inside `bounds` (the
+    # level extents) and offsets() snaps it to whole pixels for drawing.
+    def __init__(self, bounds=None, mode='dead_zone', smoothing=0.1, dead_zone=(200, 150)):
+        self.bounds = bounds
+        self.mode = mode
+        self.smoothing = smoothing
+        self.dead_zone = dead_zone  # distance (x, y) the target keeps from the screen edges
+        self.x = self.y = 0
+        self.prev_x = self.prev_y = 0  # position before the last simulation step, for interpolation
+
+    def save_position(self):
+        self.prev_x, self.prev_y = self.x, self.y
+
+    def follow(self, target, *others):
+        rect = target.rect
+        if self.mode == 'smooth':
+            area = rect.unionall([other.rect for other in others]) if others else rect
+            self.x += (area.centerx - WIDTH / 2 - self.x) * self.smoothing
+            self.y += (area.centery - HEIGHT / 2 - self.y) * self.smoothing
+        else:
+            margin_x, margin_y = self.dead_zone
+            if ((rect.right - self.x >= WIDTH - margin_x) and target.x_v > 0) or (
+                (rect.left - self.x <= margin_x) and target.x_v < 0):
+                self.x += target.x_v
+            if (rect.top - self.y) <= margin_y and target.y_v < 0:
+                self.y += target.y_v
+            elif (rect.bottom - self.y) >= (HEIGHT - margin_y - target.height) and target.y_v > 0.7:
+                self.y += target.y_v
+        if others:
+            for body in (*reversed(others), target):
+                self.x = min(max(self.x, body.rect.right - WIDTH), body.rect.left)
+                self.y = min(max(self.y, body.rect.bottom - HEIGHT), body.rect.top)
+        if self.bounds:
+            self.x = max(self.bounds.left, min(self.x, self.bounds.right - WIDTH))
+            self.y = max(self.bounds.top, min(self.y, self.bounds.bottom - HEIGHT))
+
+    def offsets(self, alpha=1):
+        # Top left of the screen in the world, between the previous and the
+        # current step, in whole pixels
+        return (round(self.prev_x + (self.x - self.prev_x) * alpha),
+                round(self.prev_y + (self.y - self.prev_y) * alpha))
+
+    def visible_rect(self, alpha=1, margin=0):
+        # The world area on screen grown by `margin` on every side, for
+        # culling and streaming
+        return pygame.Rect(*self.offsets(alpha), WIDTH, HEIGHT).inflate(margin * 2, margin * 2)
+
+def draw(window, renderer, players, view, alpha=1, characters=None):
+    renderer.draw(window, players, view, alpha, characters)
+
+
+
+def move_player(player, tiles, dx, dy):
+    # Moves the player by its velocity one axis at a time, stopping its
+    # hitbox at the first solid tile in the way
+    x, y = player.rect.x, player.rect.y
+    player.move(dx, dy)  # Rect truncates fractional velocities
+    dx, dy = player.rect.x - x, player.rect.y - y
+    player.rect.topleft = (x, y)
+
+    dx, _ = tiles.sweep_x(player.hitbox(), dx)
+    player.move(dx, 0)
+    dy, hit = tiles.sweep_y(player.hitbox(), dy)
+    player.move(0, dy)
+    if hit and dy >= 0:
+        player.landed()
+    elif hit:
+        player.bump_head()
+
+def handle_vertical_collision(player, grid, dy, tiles=None):
+    # Hazards are irregular, so they are still tested pixel by pixel; so is
+    # terrain that `tiles` doesn't handle
     collided_objects = []
-    for obj in objects:
+    for obj in grid.query(player.rect):
+        if not obj.SOLID or (tiles is not None and tiles.handles(obj)):
+            continue
+        METRICS.count('collision_tests')
         if pygame.sprite.collide_mask(player, obj):
             collided_objects.append(obj)
             if dy > 0:
@@ -337,259 +1345,1223 @@ def handle_vertical_collision(player, objects, dy):
             collided_objects.append(obj)
     return collided_objects           
 
-def collide(player, objects, dx):
-    player.move(dx, 0)
-    player.update()
-    collided_object = None 
-    for obj in objects:
-        if pygame.sprite.collide_mask(player, obj):
-            collided_object = obj
-            break
-    player.move(-dx, 0)
-    player.update()
-    return collided_object
+def collide(player, grid, dx, tiles=None):
+    # First hazard the player would touch after moving dx, tested by
+    # offsetting the masks rather than moving the player there and back
+    rect = player.rect.move(dx, 0)
+    for obj in grid.query(rect):
+        if not obj.SOLID or (tiles is not None and tiles.handles(obj)):
+            continue
+        METRICS.count('collision_tests')
+        if player.mask.overlap(obj.mask, (obj.rect.x - rect.x, obj.rect.y - rect.y)):
+            return obj
+    return None
+
+
+def handle_move(player, grid, tiles, keys=None, current_time=None):
+    if keys is None:
+        keys = pygame.key.get_pressed()
+    if current_time is None:
+        current_time = pygame.time.get_ticks()
 
+    move_player(player, tiles, player.x_v, player.y_v)
+    vertical_collide = handle_vertical_collision(player, grid, player.y_v, tiles)
 
-def handle_move(player, objects):
-    keys = pygame.key.get_pressed()
-    
     player.x_v = 0
-    collide_left = collide(player, objects, -PLAYER_SPEED*2) #multiplying by 2 to make sure the player is not touching the object
-    collide_right = collide(player, objects, PLAYER_SPEED*2) #multiplying by 2 to make sure the player is not touching the object
-    if keys[pygame.K_LEFT] and not collide_left:
+    collide_left = collide(player, grid, -PLAYER_SPEED*2, tiles) #multiplying by 2 to make sure the player is not touching the object
+    collide_right = collide(player, grid, PLAYER_SPEED*2, tiles) #multiplying by 2 to make sure the player is not touching the object
+    left, right, _ = player.controls
+    if keys[left] and not collide_left:
         player.move_left(PLAYER_SPEED)
-    if keys[pygame.K_RIGHT] and not collide_right:
+    if keys[right] and not collide_right:
         player.move_right(PLAYER_SPEED)
     elif player.rect.left < 0:
         player.x_v = 0    
       
-    vertical_collide = handle_vertical_collision(player, objects, player.y_v)
     to_check = [collide_left, collide_right, *vertical_collide]
-    current_time = pygame.time.get_ticks()
     player.update()
     for obj in to_check:
         if obj and obj.name == 'fire' and not player.hit:
-            player.make_hit(pygame.time.get_ticks())
-
-def menu(window):
-    WIDTH, HEIGHT = window.get_size()
-
-    # Load font images
-    letters = load_font_spritesheet(join('assets', 'Menu', 'Text', 'Text (White) (8x10).png'))
-
-    bg, bg_image = get_bg('Gray.png')
-    first_level_track.stop()
-    menu_music.play(-1)
-    
-    # Load cursor image
-    cursor_image = pygame.image.load(join('assets', 'Other', 'cursor.png')).convert_alpha()
-
-    # Load button images
-    normal_button = pygame.image.load(join('other_assets', 'png@0.5x', 'Buttons', 
-                                           'Rect', 'PlayText', 'Default@0.5x.png'))
-    hover_button = pygame.image.load(join('other_assets', 'png@0.5x', 'Buttons', 
-                                          'Rect', 'PlayText', 'Hover@0.5x.png'))
-    scaled_normal_button = pygame.transform.scale2x(normal_button)
-    scaled_hover_button = pygame.transform.scale2x(hover_button)
-
-    # Load sound button images
-    sound_on = pygame.image.load(join('other_assets', 'png@0.5x', 'Buttons', 'Square', 'SoundOn', 'Default@0.5x.png'))
-    sound_on_hover = pygame.image.load(join('other_assets', 'png@0.5x', 'Buttons', 'Square', 'SoundOn', 'Hover@0.5x.png'))
-    sound_off = pygame.image.load(join('other_assets', 'png@0.5x', 'Buttons', 'Square', 'SoundOff', 'Default@0.5x.png'))
-    sound_off_hover = pygame.image.load(join('other_assets', 'png@0.5x', 'Buttons', 'Square', 'SoundOff', 'Hover@0.5x.png'))
-    scaled_sound_on = pygame.transform.scale2x(sound_on)
-    scaled_sound_on_hover = pygame.transform.scale2x(sound_on_hover)
-    scaled_sound_off = pygame.transform.scale2x(sound_off)
-    scaled_sound_off_hover = pygame.transform.scale2x(sound_off_hover)
-
-    sound_button_image = scaled_sound_on
-    sound_button_hover_image = scaled_sound_on_hover
-    sound_button_rect = sound_button_image.get_rect(topleft=(20, HEIGHT - 20 - sound_button_image.get_height()))
-    sound_enabled = True
-
-    button_rect = scaled_normal_button.get_rect(center=(WIDTH // 2, HEIGHT // 2))
-
-    # Draw "Click or press Enter" below the play button
-    info_text = "CLICK OR PRESS ENTER"
-    info_text_pos = (WIDTH // 2 - len(info_text) * 8, HEIGHT // 2 + 60)
-
-
-    run = True
-    while run:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run = False
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                if button_rect.collidepoint(event.pos):
-                    menu_music.stop()
-                    first_level_track.play(-1)
-                    main(window, sound_enabled)  # Call the main function if clicked on button
-                if sound_button_rect.collidepoint(event.pos):
-                    sound_enabled = not sound_enabled  # Toggle sound state
-                    if sound_enabled:
-                        pygame.mixer.unpause()
-                        sound_button_image = scaled_sound_on
-                        sound_button_hover_image = scaled_sound_on_hover
-                    else:
-                        pygame.mixer.pause()
-                        sound_button_image = scaled_sound_off
-                        sound_button_hover_image = scaled_sound_off_hover
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_q:
-                    run = False
-                elif event.key == pygame.K_RETURN:
-                    menu_music.stop()
-                    first_level_track.play(-1)
-                    main(window, sound_enabled)  # Call the main function if Enter is pressed
-
-        mouse_x, mouse_y = pygame.mouse.get_pos()
-        if button_rect.collidepoint((mouse_x, mouse_y)):
-            button_image = scaled_hover_button
-        else:
-            button_image = scaled_normal_button
+            player.make_hit(current_time)
 
-        if sound_button_rect.collidepoint((mouse_x, mouse_y)):
-            sound_button_current = sound_button_hover_image
-        else:
-            sound_button_current = sound_button_image
+def round_positions(values):
+    # Rounds like assigning floats to a pygame.Rect does (halves away from zero)
+    return np.where(values >= 0, np.floor(values + 0.5), np.ceil(values - 0.5)).astype(np.int64)
 
-        # Draw the background and buttons
-        window.fill((0, 0, 0))  # Optional: Fill window with black before drawing everything else
-        for tile in bg:
-            window.blit(bg_image, tile)
-        window.blit(button_image, button_rect)
-        window.blit(sound_button_current, sound_button_rect)
-        blit_text(window, info_text, info_text_pos, letters)
-        window.blit(cursor_image, (mouse_x, mouse_y))
+class Character:
+    # One body of a CharacterSystem; its state lives in the system's arrays
+    __slots__ = ('name', 'system', 'slot')
+
+    def __init__(self, name):
+        self.name = name
+        self.system = None
+        self.slot = None
 
-        pygame.display.update()
+    @property
+    def rect(self):
+        return pygame.Rect(self.system.x[self.slot], self.system.y[self.slot], *self.system.size)
 
-    pygame.quit()
-    sys.exit()
-
-def pause():
-    pass
-
-def generate_level(size):
-    level_blocks = []
-    
-    
-    # Elevated platforms
-    #level_blocks.append(Block(5 * size, HEIGHT - size * 3, size))
-    #level_blocks.append(Block(6 * size, HEIGHT - size * 3, size))
-    level_blocks.append(Block(10 * size, HEIGHT - size * 5, size))
-    level_blocks.append(Block(15 * size, HEIGHT - size * 2, size))
-    level_blocks.append(Block(16 * size, HEIGHT - size * 2, size))
-    level_blocks.append(Block(17 * size, HEIGHT - size * 2, size))
-
-    # Challenging gaps
-    level_blocks.append(Block(20 * size, HEIGHT - size * 4, size))
-    level_blocks.append(Block(24 * size, HEIGHT - size * 4, size))
-
-    # High platform
-    for i in range(25, 30):
-        level_blocks.append(Block(i * size, HEIGHT - size * 6, size))
-
-    # Stair-like ascending platforms
-    for i in range(5):
-        level_blocks.append(Block((2 + i) * size, HEIGHT - size * (2 + i), size))
-
-    # Isolated platforms requiring precise jumps
-    level_blocks.append(Block(8 * size, HEIGHT - size * 7, size))
-    level_blocks.append(Block(22 * size, HEIGHT - size * 5, size))
-    level_blocks.append(Block(23 * size, HEIGHT - size * 5, size))
-
-    # A tricky gap that requires a longer jump
-    level_blocks.append(Block(13 * size, HEIGHT - size * 3, size))
-    level_blocks.append(Block(19 * size, HEIGHT - size * 3, size))  # Landing platform after the gap
-
-    # Elevated platforms for advanced navigation
-    level_blocks.append(Block(28 * size, HEIGHT - size * 7, size))
-    level_blocks.append(Block(29 * size, HEIGHT - size * 8, size))  # Highest point in the level
-
-    # Additional complex structures
-    # Zig-zag platforms for complex jumping puzzles
-    level_blocks.append(Block(12 * size, HEIGHT - size * 6, size))
-    level_blocks.append(Block(13 * size, HEIGHT - size * 7, size))
-    level_blocks.append(Block(14 * size, HEIGHT - size * 8, size))
-
-    # A series of small platforms that act as a maze
-    for j in range(1, 5):
-        level_blocks.append(Block((30 - j) * size, HEIGHT - size * (2 + j), size))
-        level_blocks.append(Block((25 - j) * size, HEIGHT - size * (3 + j), size))
-
-    return level_blocks
-
-
-
-def main(window, sound_enabled=True):
-    clock = pygame.time.Clock()
-    bg, bg_image = get_bg('Blue.png')
-    block_size = 96
-    pause_button = pygame.image.load(join('other_assets', 'png@0.5x', 'Buttons', 'Square', 'Pause', 'Default@0.5x.png')).convert_alpha()
-    pause_button_hover = pygame.image.load(join('other_assets', 'png@0.5x', 'Buttons', 'Square', 'Pause', 'Hover@0.5x.png')).convert_alpha()
-    player = Player(100, 100, 50, 50)
-    floor = [Block(i * block_size, HEIGHT - block_size, block_size) for i in range(-WIDTH // block_size, (WIDTH * 10) // block_size)]
+    def walk(self, direction):
+        # -1 left, 1 right, 0 stand still, from the next step on
+        self.system.walk[self.slot] = direction
+
+    def jump(self):
+        self.system.jumps[self.slot] += 1
+
+class CharacterSystem:
+    # Every character besides the players (AI agents, mostly) stepped in
+    # one batched pass. Positions, velocities and jump state live
+    # in NumPy arrays indexed by slot, like TrapSystem, and gravity, walking,
+    # jumping and the tile sweeps run on all of them at once by the rules of
+    # Player and move_player(). Characters only collide with terrain; hazards
+    # and goals are the players' business.
+    ANIMATIONS = ('idle', 'run', 'jump', 'double_jump', 'fall')
+    IDLE, RUN, JUMP, DOUBLE_JUMP, FALL = range(len(ANIMATIONS))
+    TURN_CHANCE = 0.002  # per step, for an agent to turn around on its own
+    ARRAYS = ('x', 'y', 'prev_x', 'prev_y', 'x_v', 'y_v', 'fall_count', 'jump_count', 'right', 'animation',
+              'animation_count', 'shown', 'sheet', 'walk', 'jumps', 'blocked', 'agent')
+
+    def __init__(self, tiles, capacity=64, seed=0):
+        self.tiles = tiles
+        self.characters = []  # slot -> Character
+        self.sheets = []  # sheet index -> [animation][facing right] -> frames, shared per character name
+        self.sheet_index = {}  # character name -> sheet index
+        self.size = Player.SPRITES['idle_left'][0].get_size()
+        self.rng = np.random.default_rng(seed)  # agents' decisions, seeded so runs repeat
+        for name in self.ARRAYS:
+            setattr(self, name, np.zeros(capacity, np.float64 if name in ('x_v', 'y_v') else np.int64))
+
+    def __len__(self):
+        return len(self.characters)
+
+    def add(self, character, x, y, agent=False):
+        slot = len(self.characters)
+        if slot == len(self.x):
+            for name in self.ARRAYS:
+                array = getattr(self, name)
+                setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self.characters.append(character)
+        character.system, character.slot = self, slot
+        if character.name not in self.sheet_index:
+            sprites = character_sprites(character.name)
+            self.sheet_index[character.name] = len(self.sheets)
+            self.sheets.append([[sprites[f'{name}_left'], sprites[f'{name}_right']] for name in self.ANIMATIONS])
+        for name in self.ARRAYS:
+            getattr(self, name)[slot] = 0
+        self.x[slot] = self.prev_x[slot] = x
+        self.y[slot] = self.prev_y[slot] = y
+        self.sheet[slot] = self.sheet_index[character.name]
+        self.agent[slot] = agent
+        if agent:
+            self.walk[slot] = self.rng.choice((-1, 1))
+        return character
+
+    def remove(self, character):
+        # The last character moves into the freed slot so the arrays stay dense
+        slot, last = character.slot, len(self.characters) - 1
+        moved = self.characters.pop()
+        if moved is not character:
+            self.characters[slot] = moved
+            moved.slot = slot
+            for name in self.ARRAYS:
+                array = getattr(self, name)
+                array[slot] = array[last]
+        character.system = character.slot = None
+
+    def steer(self, count):
+        # Agents walk until a wall stops them, jump it (twice if they have
+        # to) and turn back when that wasn't enough
+        agent = self.agent[:count] == 1
+        walk, jump_count = self.walk[:count], self.jump_count[:count]
+        stuck = agent & (self.blocked[:count] == 1) & (self.y_v[:count] >= 0)
+        turn = (stuck & (jump_count >= 2)) | (agent & (self.rng.random(count) < self.TURN_CHANCE))
+        walk[turn] *= -1
+        self.jumps[:count][stuck & ~turn & (jump_count <= 1)] = 1
+
+    def step(self, awake=None):
+        # One SIM_STEP for every character; with an `awake` rect, characters
+        # outside its columns stand still (their terrain may not be loaded);
+        # characters that aren't agents always move
+        count = len(self.characters)
+        if not count:
+            return
+        self.steer(count)
+        x, y, x_v, y_v = self.x[:count], self.y[:count], self.x_v[:count], self.y_v[:count]
+        fall_count, jump_count, animation_count = self.fall_count[:count], self.jump_count[:count], self.animation_count[:count]
+        self.prev_x[:count], self.prev_y[:count] = x, y
+        live = np.ones(count, bool) if awake is None else (x >= awake.left) & (x < awake.right)
+        live |= self.agent[:count] == 0
+
+        # Player.jump() and Player.loop()
+        jumps = self.jumps[:count]
+        jump = live & (jumps > 0) & (jump_count <= 1)
+        jumps[jumps > 0] -= 1
+        y_v[jump] = -Player.GRAVITY * 8
+        animation_count[jump] = 0
+        jump_count[jump] += 1
+        fall_count[jump & (jump_count == 1)] = 0
+        y_v[live] += np.minimum(1, fall_count[live] / FPS * Player.GRAVITY)
+        fall_count[live] += 1
+
+        # Player.update_sprite()
+        animation = self.animation[:count]
+        animation[:] = self.IDLE
+        animation[x_v != 0] = self.RUN
+        animation[y_v > Player.GRAVITY * 2] = self.FALL
+        rising = y_v < 0
+        animation[rising] = self.IDLE
+        animation[rising & (jump_count == 1)] = self.JUMP
+        animation[rising & (jump_count == 2)] = self.DOUBLE_JUMP
+        self.shown[:count] = animation_count
+        animation_count += 1
+
+        # move_player()
+        hitbox = Player.hitbox_area()
+        dx = np.where(live, round_positions(x + x_v) - x, 0)
+        dy = np.where(live, round_positions(y + y_v) - y, 0)
+        dx, blocked = self.tiles.sweep_many(x + hitbox.x, y + hitbox.y, hitbox.width, hitbox.height, dx, 0)
+        x += dx
+        dy, hit = self.tiles.sweep_many(x + hitbox.x, y + hitbox.y, hitbox.width, hitbox.height, dy, 1)
+        y += dy
+        landed, bumped = hit & (dy >= 0), hit & (dy < 0)
+        y_v[landed] = 0
+        fall_count[landed] = 0
+        jump_count[landed] = 0
+        y_v[bumped] *= -1
+        self.blocked[:count] = blocked
+
+        # handle_move(): walking sets the velocity of the next step
+        walk = self.walk[:count]
+        x_v[live] = walk[live] * PLAYER_SPEED
+        x_v[live & (walk <= 0) & (x < 0)] = 0  # nobody walks on past the left edge of the world
+        right = self.right[:count]
+        turned = live & (walk != 0) & ((walk > 0) != (right == 1))
+        right[turned] ^= 1
+        animation_count[turned] = 0
+
+    def respawn(self, bottom, position):
+        # Characters that fell below `bottom` start over at `position`
+        count = len(self.characters)
+        fallen = self.y[:count] > bottom
+        for name in ('x', 'prev_x'):
+            getattr(self, name)[:count][fallen] = position[0]
+        for name in ('y', 'prev_y'):
+            getattr(self, name)[:count][fallen] = position[1]
+        for name in ('y_v', 'fall_count', 'jump_count'):
+            getattr(self, name)[:count][fallen] = 0
+
+    def draw(self, window, offset_x, offset_y, alpha=1):
+        count = len(self.characters)
+        if not count:
+            return
+        x = self.prev_x[:count] + (self.x[:count] - self.prev_x[:count]) * alpha - offset_x
+        y = self.prev_y[:count] + (self.y[:count] - self.prev_y[:count]) * alpha - offset_y
+        width, height = self.size
+        visible = np.flatnonzero((x > -width) & (x < WIDTH) & (y > -height) & (y < HEIGHT))
+        x, y = x[visible].tolist(), y[visible].tolist()
+        sheets, animations, rights, shown = (self.sheet[visible].tolist(), self.animation[visible].tolist(),
+                                             self.right[visible].tolist(), self.shown[visible].tolist())
+        for i in range(len(visible)):
+            frames = self.sheets[sheets[i]][animations[i]][rights[i]]
+            window.blit(frames[shown[i] // Player.ANIMATION_DELAY % len(frames)], (x[i], y[i]))
+
+class PhaseTimer:
+    # Accumulates wall-clock time spent in each named phase of a frame
+    def __init__(self):
+        self.samples = {}
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+    def report(self):
+        # name -> (mean ms, p95 ms, total ms)
+        result = {}
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            result[name] = (sum(samples) / len(samples) * 1000,
+                            ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+                            sum(samples) * 1000)
+        return result
+
+@contextmanager
+def no_timing(name):
+    yield
+
+class FrameMetrics:
+    # What each frame of the game loop cost: milliseconds per phase and
+    # counts of the expensive operations, over a rolling window of frames.
+    # Works as the timer of Level.step(). F3 shows it on screen and
+    # --metrics FILE exports its rolling percentiles once a second, as CSV
+    # or JSONL depending on the file extension.
+    PHASES = ('frame', 'events', 'player', 'fire', 'characters', 'collision', 'draw', 'hud', 'flush', 'display')
+    COUNTERS = ('collision_tests', 'mask_builds', 'blits')
+    WINDOW = 300  # frames
+    EXPORT_EVERY = 1  # seconds
+
+    def __init__(self):
+        self.current = dict.fromkeys(self.PHASES + self.COUNTERS, 0)
+        self.history = {name: deque(maxlen=self.WINDOW) for name in self.current}
+        self.frames = 0
+        self.frame_start = None
+        self.file = None
+        self.exported = 0  # perf_counter() of the last export
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[name] += (time.perf_counter() - start) * 1000
+
+    def count(self, name, amount=1):
+        self.current[name] += amount
+
+    def end_frame(self):
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.current['frame'] = (now - self.frame_start) * 1000
+        self.frame_start = now
+        for name, value in self.current.items():
+            self.history[name].append(value)
+            self.current[name] = 0
+        self.frames += 1
+        if self.file and now - self.exported >= self.EXPORT_EVERY:
+            self.exported = now
+            self.write()
+
+    def percentiles(self):
+        # name -> (p50, p95, p99) over the window
+        result = {}
+        for name, values in self.history.items():
+            ordered = sorted(values) or [0]
+            result[name] = tuple(ordered[min(len(ordered) - 1, int(len(ordered) * q))] for q in (0.5, 0.95, 0.99))
+        return result
+
+    def export_to(self, path):
+        self.csv = path.endswith('.csv')
+        self.file = open(path, 'w', buffering=1)
+        self.exported = time.perf_counter()
+        if self.csv:
+            self.file.write('frame,metric,p50,p95,p99\n')
+
+    def write(self):
+        percentiles = self.percentiles()
+        if self.csv:
+            for name, (p50, p95, p99) in percentiles.items():
+                self.file.write(f'{self.frames},{name},{p50:.4f},{p95:.4f},{p99:.4f}\n')
+        else:
+            self.file.write(json.dumps({'frame': self.frames, 'metrics': {
+                name: dict(zip(('p50', 'p95', 'p99'), values)) for name, values in percentiles.items()}}) + '\n')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def overlay_lines(self):
+        lines = [f"{'MS (COUNT)':<16}  P50   P95   P99"]
+        for name, values in self.percentiles().items():
+            digits = 2 if name in self.PHASES else 0
+            lines.append(f"{name.replace('_', ' ').upper():<16}" + ' '.join(f'{value:5.{digits}f}' for value in values))
+        return lines
+
+METRICS = FrameMetrics()
+
+class ScriptedKeys:
+    # Stands in for pygame.key.get_pressed() with a fixed set of held keys
+    def __init__(self, pressed=()):
+        self.pressed = set(pressed)
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+# Input sources feed a level one simulation step at a time: read() returns
+# the keys held during the step and how many jumps were pressed since the
+# previous one (a list with a count per player when there are several).
+# Together with Level.time as the clock, this is everything a run depends
+# on, so a recorded session replays identically.
+INPUT_KEYS = tuple(key for left, right, _ in PLAYER_CONTROLS for key in (left, right))
+
+class KeyboardInput:
+    # The players at the keyboard; jumps come from KEYDOWN events
+    def __init__(self, players=1):
+        self.jumps = [0] * players
+
+    def jump(self, player=0):
+        self.jumps[player] += 1
+
+    def read(self):
+        pressed = pygame.key.get_pressed()
+        jumps, self.jumps = self.jumps, [0] * len(self.jumps)
+        return [key for key in INPUT_KEYS if pressed[key]], jumps if len(jumps) > 1 else jumps[0]
+
+class ScriptedInput:
+    # Input from script(step) -> (held keys, jump pressed)
+    def __init__(self, script):
+        self.script = script
+        self.steps = 0
+
+    def read(self):
+        held, jump_pressed = self.script(self.steps)
+        self.steps += 1
+        return list(held), int(jump_pressed)
+
+class InputRecorder:
+    # Passes another source through and writes every step to a JSONL file:
+    # a header naming the level, then one line per step. Every attempt
+    # (e.g. a retry after game over) is a session of its own, so the second
+    # one goes to name-2.jsonl, the third to name-3.jsonl and so on.
+    attempts = 0  # sessions recorded by this process
+
+    def __init__(self, source, path, level_path, lives, players=1):
+        InputRecorder.attempts += 1
+        if self.attempts > 1:
+            root, extension = os.path.splitext(path)
+            path = f'{root}-{self.attempts}{extension}'
+        self.path = path
+        self.source = source
+        self.file = open(path, 'w', buffering=1)  # line buffered, so a crash keeps what was played
+        self.file.write(json.dumps({'level': level_path, 'lives': lives, 'players': players}) + '\n')
+
+    def read(self):
+        held, jumps = self.source.read()
+        self.file.write(json.dumps([held, jumps]) + '\n')
+        return held, jumps
+
+    def close(self):
+        self.file.close()
+
+class InputReplay:
+    # Plays back a file written by InputRecorder
+    def __init__(self, path):
+        with open(path) as file:
+            self.header = json.loads(file.readline())
+            self.steps = [json.loads(line) for line in file if line.strip()]
+        self.position = 0
+
+    def __len__(self):
+        return len(self.steps)
+
+    def read(self):
+        if self.position >= len(self.steps):
+            return [], 0
+        held, jumps = self.steps[self.position]
+        self.position += 1
+        return held, jumps
+
+    def level(self):
+        level = Level.load(self.header['level'])
+        for _ in range(1, self.header.get('players', 1)):
+            level.add_player()
+        for player in level.players:
+            player.lives = self.header['lives']
+        return level
+
+FIRST_LEVEL = join('levels', 'level1.json')
+
+def build_block_tile(x, y, size):
+    return [POOL.acquire(Block, x, y, size)]
+
+def build_fire_tile(x, y, size):
     #multiplying and dividing by 3 because there are three fire widths in one block size
-    fire = [Fire(i*block_size/3, HEIGHT - block_size - 64, 16, 32) for i in range (3*3,15*3)]
+    return [POOL.acquire(Fire, x + i * size / 3, y + size - 64, 16, 32) for i in range(3)]
+
+def build_goal_tile(x, y, size):
+    return [POOL.acquire(Goal, x, y, size)]
+
+TILE_BUILDERS = {'#': build_block_tile, 'F': build_fire_tile, 'G': build_goal_tile}
+
+class LevelData:
+    # A level file. `tiles` are rows of characters from top to bottom, the last
+    # row sitting on the bottom of the screen: '#' is a block, 'F' a cell with
+    # three fires on its floor and anything else is empty. `origin` is the
+    # world column of the first character.
+    def __init__(self, tiles, tile_size=96, origin=0, start=(100, 100), background='Blue.png', music=None, name='',
+                 parallax=0.5, next=None, camera='dead_zone'):
+        self.tiles = tiles
+        self.tile_size = tile_size
+        self.origin = origin
+        self.start = start
+        self.background = background
+        self.music = music  # track in assets/Music, streamed while the level runs
+        self.name = name
+        self.parallax = parallax  # background scroll speed relative to the camera
+        self.next = next  # file of the level after this one, next to this one
+        self.camera = camera  # Camera mode, 'dead_zone' or 'smooth'
+        self.path = None
+        self.columns = max(len(row) for row in tiles)
+
+    def bounds(self):
+        # World area the camera may show: the tiles plus a screen of sky above them
+        size = self.tile_size
+        top = HEIGHT - size * len(self.tiles) - HEIGHT
+        return pygame.Rect(self.origin * size, top, self.columns * size, HEIGHT - top)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            data = cls(**json.load(file))
+        data.path = path
+        return data
+
+    def next_path(self):
+        return join(os.path.dirname(self.path), self.next) if self.next else None
+
+    def assets(self):
+        # Image files the level draws
+        return [TERRAIN_IMAGE, GOAL_IMAGE, (background_path(self.background), False),
+                *sprite_sheet_files('Traps', 'Fire')]
+
+    def build(self, first_column, last_column):
+        # Instantiates the objects of columns [first_column, last_column)
+        objects = []
+        size = self.tile_size
+        for row_index, row in enumerate(self.tiles):
+            y = HEIGHT - size * (len(self.tiles) - row_index)
+            for column in range(max(first_column, 0), min(last_column, len(row))):
+                builder = TILE_BUILDERS.get(row[column])
+                if builder:
+                    objects.extend(builder((column + self.origin) * size, y, size))
+        return objects
+
+class ChunkStreamer:
+    # Keeps only the part of a level near the camera instantiated. The level
+    # is split into chunks of CHUNK_COLUMNS tile columns; chunks within
+    # LOAD_MARGIN of the view are built and chunks more than KEEP_MARGIN away
+    # are evicted.
+    CHUNK_COLUMNS = 8
+    LOAD_MARGIN = 1
+    KEEP_MARGIN = 3
+
+    def __init__(self, data, level):
+        self.data = data
+        self.level = level
+        self.loaded = {}  # chunk index -> objects
+
+    def chunk_range(self, view, margin):
+        chunk_width = self.CHUNK_COLUMNS * self.data.tile_size
+        first = (view.left - self.data.origin * self.data.tile_size) // chunk_width - margin
+        last = (view.right - 1 - self.data.origin * self.data.tile_size) // chunk_width + margin
+        chunks = (self.data.columns - 1) // self.CHUNK_COLUMNS
+        return range(max(first, 0), min(last, chunks) + 1)
+
+    def load(self, index):
+        objects = self.data.build(index * self.CHUNK_COLUMNS, (index + 1) * self.CHUNK_COLUMNS)
+        self.loaded[index] = objects
+        self.level.add_objects(objects)
+
+    def update(self, view):
+        for index in self.chunk_range(view, self.LOAD_MARGIN):
+            if index not in self.loaded:
+                self.load(index)
+        keep = self.chunk_range(view, self.KEEP_MARGIN)
+        for index in [index for index in self.loaded if index not in keep]:
+            objects = self.loaded.pop(index)
+            self.level.remove_objects(objects)
+            POOL.release(objects)
+
+class Level:
+    # Simulation state of one play-through: the player, the level objects and
+    # the camera. step() advances one fixed SIM_STEP, draw() renders it.
+    def __init__(self, objects=(), player=None, background='Blue.png', block_size=96, data=None, parallax=0,
+                 build_view=True):
+        self.player = player or Player(100, 100, 50, 50)
+        self.players = [self.player]  # everyone at the keyboard; the first one is `player`
+        self.traps = {}  # id of a trap's sprite sheets -> TrapSystem
+        self.goals = {}  # used as an ordered set
+        self.completed = False  # a goal was reached
+        self.data = data
+        self.grid = SpatialGrid(block_size)
+        self.tiles = TileMap(block_size)
+        self.characters = CharacterSystem(self.tiles)  # everyone but the player
+        self.renderer = Renderer(self.grid, [ParallaxLayer(background, parallax)])
+        self.camera = Camera(data.bounds(), data.camera) if data else Camera()
+        self.jumps_requested = [0]  # per player
+        self.time = 0  # milliseconds of game time
+        self.music = None
+        self.add_objects(objects)
+        # Levels loaded from a file are streamed in around the camera; with
+        # build_view=False the first chunks are left to the caller
+        self.streamer = None
+        if data is not None:
+            self.streamer = ChunkStreamer(data, self)
+            if build_view:
+                self.streamer.update(self.view())
+
+    @classmethod
+    def load(cls, path, player=None):
+        return cls.from_data(LevelData.load(path), player)
+
+    @classmethod
+    def from_data(cls, data, player=None, build_view=True):
+        level = cls(player=player or Player(*data.start, 50, 50), background=data.background,
+                    block_size=data.tile_size, data=data, parallax=data.parallax, build_view=build_view)
+        level.music = data.music
+        return level
+
+    def add_objects(self, objects):
+        for obj in objects:
+            if isinstance(obj, Fire):
+                self.trap_system(obj.fire).add(obj)
+            elif isinstance(obj, Goal):
+                self.goals[obj] = None
+            elif self.tiles.handles(obj):
+                self.tiles.add(obj.rect)
+            self.grid.insert(obj)
+        if objects:
+            self.renderer.invalidate(objects[0].rect.unionall([obj.rect for obj in objects]))
+
+    def remove_objects(self, objects):
+        for obj in objects:
+            self.grid.remove(obj)
+            if isinstance(obj, Fire) and obj.trap is not None:
+                obj.trap.remove(obj)
+            elif isinstance(obj, Goal):
+                self.goals.pop(obj, None)
+            elif self.tiles.handles(obj):
+                self.tiles.remove(obj.rect)
+        if objects:
+            self.renderer.invalidate(objects[0].rect.unionall([obj.rect for obj in objects]))
+
+    def next_level(self, preloaded=None):
+        # The level after this one, with the players and their lives carried over
+        level = preloaded or Level.load(self.data.next_path())
+        for _ in self.players[len(level.players):]:
+            level.add_player()
+        for player, carried in zip(level.players, self.players):
+            player.lives = carried.lives
+        return level
+
+    def add_player(self):
+        # Another player on the same keyboard, with the next character and
+        # controls, starting where the first one did
+        index = len(self.players)
+        x, y = self.data.start if self.data else (100, 100)
+        player = Player(x, y, 50, 50, character=CHARACTERS[index], controls=PLAYER_CONTROLS[index])
+        self.players.append(player)
+        self.jumps_requested.append(0)
+        return player
+
+    def add_character(self, name, x, y, agent=False):
+        return self.characters.add(Character(name), x, y, agent)
+
+    def spawn_agents(self, count, seed=0):
+        # `count` AI characters dropped in around the start, taking turns
+        # with every character's sprites
+        rng = random.Random(seed)
+        x, y = self.data.start if self.data else (100, 100)
+        return [self.add_character(CHARACTERS[i % len(CHARACTERS)], x + rng.randrange(0, WIDTH - 200),
+                                   y - rng.randrange(0, 200), agent=True) for i in range(count)]
+
+    def awake_area(self):
+        # Characters are only simulated where the terrain around them is
+        # sure to be loaded: within a chunk (less a tile) of the view
+        if self.streamer is None:
+            return None
+        margin = (ChunkStreamer.CHUNK_COLUMNS - 1) * self.data.tile_size
+        return self.view().inflate(margin * 2, 0)
+
+    def trap_system(self, sheets):
+        system = self.traps.get(id(sheets))
+        if system is None:
+            system = self.traps[id(sheets)] = TrapSystem(sheets, Fire.ANIMATION_DELAY)
+        return system
+
+    def view(self):
+        return self.camera.visible_rect()
+
+    def read_input(self, source):
+        # Keys for the next step() from an input source
+        held, jumps = source.read()
+        for index, count in enumerate(jumps if isinstance(jumps, list) else [jumps]):
+            if index < len(self.players):
+                self.jumps_requested[index] += count
+        return ScriptedKeys(held)
+
+    def step(self, keys=None, timer=no_timing):
+        # Game time advances by exactly SIM_STEP per step, independent of the wall clock
+        self.time += SIM_STEP
+        current_time = self.time
+        for player in self.players:
+            player.save_position()
+        self.camera.save_position()
+
+        with timer('player'):
+            for index, player in enumerate(self.players):
+                if self.jumps_requested[index]:
+                    self.jumps_requested[index] -= 1
+                    if player.jump_count <= 1:
+                        player.jump()
+                player.update_hit(current_time)
+                player.loop(FPS)
+        with timer('fire'):
+            for system in self.traps.values():
+                system.step()
+        with timer('characters'):
+            self.characters.step(self.awake_area())
+            if self.data:
+                self.characters.respawn(self.camera.bounds.bottom, self.data.start)
+        with timer('collision'):
+            # Every player takes damage and reaches goals the same way; one
+            # of them reaching a goal completes the level
+            for player in self.players:
+                handle_move(player, self.grid, self.tiles, keys, current_time)
+                hitbox = player.hitbox()
+                if any(hitbox.colliderect(goal.rect) for goal in self.goals):
+                    self.completed = True
+
+        for player in self.players:
+            if player.lives <= 0 and not player.dead:
+                player.die()
+        self.camera.follow(*self.players)
+        if self.streamer:
+            self.streamer.update(self.view())
+
+    def draw(self, window, alpha=1):
+        draw(window, self.renderer, self.players, self.camera.visible_rect(alpha), alpha, self.characters)
+
+class LevelPreloader:
+    # Gets the next level ready while the current one is played. The file is
+    # parsed, its images decoded and its music read on the worker pool, then
+    # step() builds the level a piece at a time (the level itself, each chunk
+    # around the start, each pre-rendered screen chunk) within a time budget,
+    # so switching to it costs nothing on the frame it starts.
+    def __init__(self, path):
+        self.path = path
+        self.level = None
+        self.work = self.build()
+
+    def build(self):
+        data = preload_pool().submit(LevelData.load, self.path)
+        while not data.done():
+            yield
+        data = data.result()
+        if data.music:
+            preload_pool().submit(AUDIO.prefetch_music, data.music)
+        images = AssetPreloader(data.assets())
+        while not images.done:
+            yield
+            images.poll(budget=0)
+        level = Level.from_data(data, build_view=False)
+        yield
+        streamer = level.streamer
+        for index in streamer.chunk_range(level.view(), streamer.LOAD_MARGIN):
+            streamer.load(index)
+            yield
+        for key in level.renderer.chunk_keys(level.view()):
+            level.renderer.chunk(key)
+            yield
+        self.level = level
+
+    def step(self, budget=0.002):
+        deadline = time.perf_counter() + budget
+        while self.level is None and time.perf_counter() < deadline:
+            next(self.work, None)
+
+    def finish(self):
+        # Whatever is left, right now
+        for _ in self.work:
+            pass
+        return self.level
+
+def run_headless(level, frames, source=None, timer=no_timing):
+    # Drives a level without a player at the keyboard, as fast as it can go:
+    # one simulation step and one drawn frame per iteration, with input
+    # read from `source` (nothing pressed without one).
+    window = init_display()
+    queue = RenderQueue(window)
+    for frame in range(frames):
+        with timer('input'):
+            pygame.event.pump()
+            keys = level.read_input(source) if source else ScriptedKeys()
+        level.step(keys, timer)
+        if level.completed and level.data and level.data.next:
+            level = level.next_level()
+        with timer('draw'):
+            queue.layer = LAYER_WORLD
+            level.draw(queue)
+            dirty = queue.flush()
+        with timer('display'):
+            pygame.display.update(dirty)
+    return level
+
+def run_right_script(frame):
+    # Holds right and jumps every second, with a short step back now and then
+    held = (pygame.K_LEFT,) if frame % 240 >= 220 else (pygame.K_RIGHT,)
+    return held, frame % FPS == 0
+
+class Scene:
+    # One screen of the game driven by the SceneManager: handle_event() per
+    # input event, update() once per simulation step and draw() once per
+    # rendered frame. Resources are acquired in enter() and released in exit().
+    overlay = False  # overlays are drawn on top of the scene below them
+
+    def assets(self):
+        # Image files to decode before the scene is entered
+        return []
+
+    def enter(self, manager):
+        self.manager = manager
+
+    def exit(self):
+        pass
+
+    def resume(self):
+        # Called when the scene above this one was popped
+        pass
+
+    def handle_event(self, event):
+        pass
+
+    def update(self):
+        pass
+
+    def draw(self, queue, alpha):
+        pass
+
+class SceneManager:
+    # Runs every scene from one loop, so menus, levels and play-throughs
+    # replace each other on a stack instead of calling into one another
+    def __init__(self, window):
+        self.window = window
+        self.queue = RenderQueue(window)
+        self.stack = []
+        self.running = False
+        self.cursor_image = load_image(CURSOR_IMAGE)
+        self.show_metrics = False  # F3
+        self.metrics_lines = []
+
+    def push(self, scene):
+        self.stack.append(scene)
+        scene.enter(self)
+        self.queue.invalidate()
+
+    def pop(self):
+        self.stack.pop().exit()
+        self.queue.invalidate()
+        if self.stack:
+            self.stack[-1].resume()
+
+    def replace(self, scene):
+        self.stack.pop().exit()
+        self.push(scene)
+
+    def draw_metrics(self):
+        # The text only changes a few times a second, so the font's cached
+        # line surfaces get reused in between
+        if not self.metrics_lines or METRICS.frames % 15 == 0:
+            self.metrics_lines = METRICS.overlay_lines()
+        font = get_font(1)
+        size = (300, 12 * len(self.metrics_lines) + 8)
+        self.queue.layer = LAYER_HUD
+        self.queue.blit(cached_asset(('shade', size, 1), lambda: MessageScene.build_shade(size)), (WIDTH - 310, 60))
+        for i, line in enumerate(self.metrics_lines):
+            font.blit(self.queue, line, (WIDTH - 306, 64 + i * 12))
+
+    def load(self, scene, replace=False):
+        # Shows the loading screen while the files of `scene` are decoded in
+        # the background, then switches to it
+        preloader = AssetPreloader(scene.assets())
+        if not preloader.done:
+            scene = LoadingScene(scene, preloader)
+        if replace:
+            self.replace(scene)
+        else:
+            self.push(scene)
+
+    def pop_to(self, scene_type):
+        # Pops every scene above the topmost one of `scene_type`
+        while not isinstance(self.stack[-1], scene_type):
+            self.pop()
+
+    def quit(self):
+        self.running = False
+
+    def run(self):
+        clock = pygame.time.Clock()
+        accumulator = 0
+        self.running = True
+        while self.running and self.stack:
+            # Scenes update in fixed SIM_STEP increments, drawing runs at RENDER_FPS
+            accumulator += min(clock.tick(RENDER_FPS), SIM_STEP * MAX_STEPS_PER_FRAME)
+            with METRICS('events'):
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        self.quit()
+                    elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                        self.show_metrics = not self.show_metrics
+                    elif self.stack:
+                        self.stack[-1].handle_event(event)
+
+            steps = 0
+            while self.stack and accumulator >= SIM_STEP and steps < MAX_STEPS_PER_FRAME:
+                accumulator -= SIM_STEP
+                steps += 1
+                self.stack[-1].update()
+            # Leftover time beyond the catch-up limit is dropped, not carried over
+            accumulator = min(accumulator, SIM_STEP)
+            if not self.stack:
+                break
+
+            bottom = len(self.stack) - 1
+            while bottom > 0 and self.stack[bottom].overlay:
+                bottom -= 1
+            with METRICS('draw'):
+                # Only the top scene is updated; the ones under it are drawn
+                # where their last step left them rather than in between
+                for scene in self.stack[bottom:-1]:
+                    scene.draw(self.queue, 1)
+                self.stack[-1].draw(self.queue, accumulator / SIM_STEP)
+                if self.show_metrics:
+                    self.draw_metrics()
+                self.queue.blit(self.cursor_image, pygame.mouse.get_pos(), layer=LAYER_CURSOR)
+            with METRICS('flush'):
+                dirty = self.queue.flush()
+            with METRICS('display'):
+                pygame.display.update(dirty)
+            STARTUP.frame_drawn()
+            METRICS.end_frame()
+
+        while self.stack:
+            self.stack.pop().exit()
+
+class MenuScene(Scene):
+    BACKGROUND = 'Gray.png'
+    PLAY_BUTTON = join(BUTTONS_DIR, 'Rect', 'PlayText', 'Default@0.5x.png')
+    PLAY_BUTTON_HOVER = join(BUTTONS_DIR, 'Rect', 'PlayText', 'Hover@0.5x.png')
+    SOUND_ON = join(BUTTONS_DIR, 'Square', 'SoundOn', 'Default@0.5x.png')
+    SOUND_ON_HOVER = join(BUTTONS_DIR, 'Square', 'SoundOn', 'Hover@0.5x.png')
+    SOUND_OFF = join(BUTTONS_DIR, 'Square', 'SoundOff', 'Default@0.5x.png')
+    SOUND_OFF_HOVER = join(BUTTONS_DIR, 'Square', 'SoundOff', 'Hover@0.5x.png')
+
+    def assets(self):
+        return [FONT_SHEET, CURSOR_IMAGE, (background_path(self.BACKGROUND), False), self.PLAY_BUTTON,
+                self.PLAY_BUTTON_HOVER, self.SOUND_ON, self.SOUND_ON_HOVER, self.SOUND_OFF, self.SOUND_OFF_HOVER]
+
+    def enter(self, manager):
+        super().enter(manager)
+        self.font = get_font()
+        self.bg, self.bg_image = get_bg(self.BACKGROUND)
+
+        # Load button images
+        self.scaled_normal_button = load_image(self.PLAY_BUTTON, scale=2)
+        self.scaled_hover_button = load_image(self.PLAY_BUTTON_HOVER, scale=2)
+
+        # Load sound button images
+        self.scaled_sound_on = load_image(self.SOUND_ON, scale=2)
+        self.scaled_sound_on_hover = load_image(self.SOUND_ON_HOVER, scale=2)
+        self.scaled_sound_off = load_image(self.SOUND_OFF, scale=2)
+        self.scaled_sound_off_hover = load_image(self.SOUND_OFF_HOVER, scale=2)
+
+        self.sound_button_rect = self.scaled_sound_on.get_rect(topleft=(20, HEIGHT - 20 - self.scaled_sound_on.get_height()))
+        self.button_rect = self.scaled_normal_button.get_rect(center=(WIDTH // 2, HEIGHT // 2))
+
+        # Draw "Click or press Enter" below the play button
+        self.info_text = "CLICK OR PRESS ENTER"
+        self.info_text_pos = (WIDTH // 2 - len(self.info_text) * 8, HEIGHT // 2 + 60)
+        self.resume()
+
+    def resume(self):
+        AUDIO.play_music(MENU_TRACK)
+
+    def play(self):
+        self.manager.load(LevelScene())
+
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            if self.button_rect.collidepoint(event.pos):
+                self.play()
+            if self.sound_button_rect.collidepoint(event.pos):
+                AUDIO.set_enabled(not AUDIO.enabled)  # Toggle sound state
+        elif event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_q:
+                self.manager.quit()
+            elif event.key == pygame.K_RETURN:
+                self.play()
+
+    def draw(self, queue, alpha):
+        mouse_pos = pygame.mouse.get_pos()
+        if self.button_rect.collidepoint(mouse_pos):
+            button_image = self.scaled_hover_button
+        else:
+            button_image = self.scaled_normal_button
 
-    objects = [*floor, *generate_level(96), *fire]
-    scroll_area_width = 200
-    scroll_area_height = 150
-    offset_x = 0
-    offset_y = 0
+        hover = self.sound_button_rect.collidepoint(mouse_pos)
+        if AUDIO.enabled:
+            sound_button_current = self.scaled_sound_on_hover if hover else self.scaled_sound_on
+        else:
+            sound_button_current = self.scaled_sound_off_hover if hover else self.scaled_sound_off
 
-    pause_button_rect = pause_button.get_rect(center=(WIDTH // 2, HEIGHT // 2))
-    pause_button_image = None
+        # Draw the background and buttons
+        queue.layer = LAYER_BACKGROUND
+        for tile in self.bg:
+            queue.blit(self.bg_image, tile)
+        queue.layer = LAYER_HUD
+        queue.blit(button_image, self.button_rect)
+        queue.blit(sound_button_current, self.sound_button_rect)
+        self.font.blit(queue, self.info_text, self.info_text_pos)
+
+class LevelScene(Scene):
+    PAUSE_BUTTON = join(BUTTONS_DIR, 'Square', 'Pause', 'Default@0.5x.png')
+    PAUSE_BUTTON_HOVER = join(BUTTONS_DIR, 'Square', 'Pause', 'Hover@0.5x.png')
+
+    def __init__(self, path=FIRST_LEVEL):
+        self.path = path
+        self.data = LevelData.load(path)
+
+    def assets(self):
+        return [*self.data.assets(), self.PAUSE_BUTTON, self.PAUSE_BUTTON_HOVER, *HEART_IMAGES,
+                *[file for name in self.characters() for file in sprite_sheet_files('MainCharacters', name)]]
+
+    @staticmethod
+    def characters():
+        # Characters a level will show: the players', or all of them with agents
+        return CHARACTERS if AGENTS else CHARACTERS[:PLAYERS]
+
+    def enter(self, manager):
+        super().enter(manager)
+        self.pause_button = load_image(self.PAUSE_BUTTON)
+        self.pause_button_hover = load_image(self.PAUSE_BUTTON_HOVER)
+        self.pause_button_rect = self.pause_button.get_rect(topleft=(20, 20))
+        self.hearts = load_hearts()
+        self.level = Level.from_data(self.data)
+        for _ in range(1, PLAYERS):
+            self.level.add_player()
+        self.keyboard = self.input = KeyboardInput(PLAYERS)
+        if RECORDING:
+            self.input = InputRecorder(self.keyboard, RECORDING, self.path, self.level.player.lives, PLAYERS)
+        self.start_level()
+
+    def start_level(self):
+        # The agents join every level at its start; the players are carried
+        # over by Level.next_level()
+        self.level.spawn_agents(AGENTS)
+        if self.level.music:
+            AUDIO.play_music(self.level.music)
+        self.next = None
+        if self.data.next:
+            self.next = LevelPreloader(self.data.next_path())
+
+    def exit(self):
+        # Release the level so nothing from this play-through outlives it
+        self.level = None
+        if RECORDING:
+            self.input.close()
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_q:
+                self.manager.quit()
+            elif event.key in (pygame.K_p, pygame.K_ESCAPE):
+                self.manager.push(PauseScene())
+            for index, (_, _, jump) in enumerate(PLAYER_CONTROLS[:PLAYERS]):
+                if event.key == jump:
+                    self.keyboard.jump(index)
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            if self.pause_button_rect.collidepoint(event.pos):
+                self.manager.push(PauseScene())
 
-    cursor_image = pygame.image.load(join('assets','Other', 'cursor.png')).convert_alpha()  # Load your cursor image
-    run = True
-    while run:
-        current_time = pygame.time.get_ticks()
-        mouse_x, mouse_y = pygame.mouse.get_pos()
-        clock.tick(FPS)
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT or pygame.key.get_pressed()[pygame.K_q]:
-                run = False
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_SPACE and player.jump_count <= 1:
-                    player.jump()
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                if pause_button_rect.collidepoint(event.pos):
-                    pause()         
-        player.update_hit(current_time)
-        player.loop(FPS)
-        for obj in fire:
-            obj.loop()
-            obj.on()
-        handle_move(player, objects)
-        draw(WINDOW, bg, bg_image, player, objects, offset_x, offset_y)
-        if pause_button_rect.collidepoint((mouse_x, mouse_y)):
-            pause_button_image = pause_button_hover
+    def update(self):
+        with METRICS('events'):
+            keys = self.level.read_input(self.input)
+        self.level.step(keys, METRICS)
+        # Players share their fate: the game is over when any of them is out of lives
+        if any(player.dead for player in self.level.players):
+            self.manager.push(GameOverScene())
+        elif self.level.completed:
+            if self.next:
+                self.level = self.level.next_level(self.next.finish())
+                self.data = self.level.data
+                self.path = self.data.path
+                self.start_level()
+            else:
+                self.manager.push(VictoryScene())
+        elif self.next:
+            self.next.step()
+
+    def draw(self, queue, alpha):
+        queue.layer = LAYER_WORLD
+        self.level.draw(queue, alpha)
+        with METRICS('hud'):
+            self.draw_hud(queue)
+
+    def draw_hud(self, queue):
+        if self.pause_button_rect.collidepoint(pygame.mouse.get_pos()):
+            pause_button_image = self.pause_button_hover
         else:
-            pause_button_image = pause_button    
+            pause_button_image = self.pause_button    
+
+        queue.layer = LAYER_HUD
+        queue.blit(pause_button_image, self.pause_button_rect)
+        for index, player in enumerate(self.level.players):
+            queue.blit(self.hearts[max(player.lives, 0)], (WIDTH - 150, 20 + index * 40))
+
+class MessageScene(Scene):
+    # Dims the scene below and shows a few lines of text on top of it
+    overlay = True
+    lines = ()
+
+    def enter(self, manager):
+        super().enter(manager)
+        self.font = get_font()
+        self.shade = cached_asset(('shade', (WIDTH, HEIGHT), 1), self.build_shade)
+
+    @staticmethod
+    def build_shade(size=(WIDTH, HEIGHT)):
+        shade = pygame.Surface(size, pygame.SRCALPHA).convert_alpha()
+        shade.fill((0, 0, 0, 150))
+        return shade
+
+    def draw(self, queue, alpha):
+        queue.layer = LAYER_HUD
+        queue.blit(self.shade, (0, 0))
+        for i, line in enumerate(self.lines):
+            self.font.blit(queue, line, (WIDTH // 2 - len(line) * 8, HEIGHT // 2 - 40 + i * 40))
+
+class LoadingScene(Scene):
+    # Shown while an AssetPreloader decodes the files of the next scene
+    BAR = pygame.Rect(WIDTH // 2 - 200, HEIGHT // 2 + 20, 400, 16)
+
+    def __init__(self, scene, preloader):
+        self.scene = scene
+        self.preloader = preloader
+
+    def enter(self, manager):
+        super().enter(manager)
+        self.font = get_font()
+        # The window isn't cleared between frames, so the whole screen is
+        # covered before the bar is drawn
+        self.background = pygame.Surface((WIDTH, HEIGHT)).convert()
+        self.background.fill((0, 0, 0))
+        self.bar_back = pygame.Surface(self.BAR.size).convert()
+        self.bar_back.fill((60, 60, 60))
+        self.bar_fill = pygame.Surface(self.BAR.size).convert()
+        self.bar_fill.fill((255, 255, 255))
 
+    def update(self):
+        self.preloader.poll()
+        if self.preloader.done:
+            self.manager.replace(self.scene)
+
+    def draw(self, queue, alpha):
+        queue.blit(self.background, (0, 0), layer=LAYER_BACKGROUND)
+        queue.layer = LAYER_HUD
+        queue.blit(self.bar_back, self.BAR)
+        queue.blit(self.bar_fill, self.BAR, (0, 0, int(self.BAR.width * self.preloader.progress), self.BAR.height))
+        self.font.blit(queue, "LOADING", (WIDTH // 2 - 7 * 8, HEIGHT // 2 - 20))
+
+class PauseScene(MessageScene):
+    lines = ("PAUSED", "PRESS P TO RESUME", "PRESS M FOR MENU")
+
+    def enter(self, manager):
+        super().enter(manager)
+        AUDIO.pause()
+
+    def exit(self):
+        AUDIO.unpause()
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key in (pygame.K_p, pygame.K_ESCAPE):
+                self.manager.pop()
+            elif event.key == pygame.K_m:
+                self.manager.pop_to(MenuScene)
+            elif event.key == pygame.K_q:
+                self.manager.quit()
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            self.manager.pop()
+
+class GameOverScene(MessageScene):
+    lines = ("GAME OVER", "PRESS ENTER TO RETRY", "PRESS M FOR MENU")
+
+    def enter(self, manager):
+        # The level's music stops with it; a retry starts the track over
+        super().enter(manager)
+        AUDIO.stop_music()
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_RETURN:
+                # Tear the finished level down before building the next one
+                self.manager.pop_to(LevelScene)
+                self.manager.load(LevelScene(self.manager.stack[-1].path), replace=True)
+            elif event.key in (pygame.K_m, pygame.K_ESCAPE):
+                self.manager.pop_to(MenuScene)
+            elif event.key == pygame.K_q:
+                self.manager.quit()
+
+class VictoryScene(MessageScene):
+    lines = ("YOU WIN", "PRESS ENTER FOR MENU")
+
+    def enter(self, manager):
+        super().enter(manager)
+        AUDIO.stop_music()
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key in (pygame.K_RETURN, pygame.K_m, pygame.K_ESCAPE):
+                self.manager.pop_to(MenuScene)
+            elif event.key == pygame.K_q:
+                self.manager.quit()
+
+def main():
+    with STARTUP.phase('display'):
+        window = init_display()
+    with STARTUP.phase('audio'):
+        init_audio()
+        AUDIO.preload_effects()
+    with STARTUP.phase('menu assets'):
+        manager = SceneManager(window)
+        menu = MenuScene()
+        AssetPreloader(menu.assets()).wait()
+        manager.push(menu)
+    metrics = option('--metrics')
+    if metrics:
+        METRICS.export_to(metrics)
+    manager.run()
+    METRICS.close()
+    pygame.quit()
 
-        window.blit(pause_button_image, (20, 20))
+def headless(frames, replay=None):
+    # Plays the first level from a scripted run, or a session recorded with
+    # --record, and prints the frame timings
+    init_display()
+    timer = PhaseTimer()
+    if replay:
+        source = InputReplay(replay)
+        level, frames = source.level(), len(source)
+    else:
+        source = ScriptedInput(run_right_script)
+        level = Level.load(FIRST_LEVEL, Player(100, 100, 50, 50, lives=frames))
+    start = time.perf_counter()
+    run_headless(level, frames, source, timer)
+    elapsed = time.perf_counter() - start
+    print(f'{frames} frames in {elapsed:.2f}s ({frames / elapsed:.0f} fps)')
+    for name, (mean, p95, total) in timer.report().items():
+        print(f'{name:>10}: mean {mean:.3f} ms  p95 {p95:.3f} ms  total {total:.0f} ms')
+
+def option(name):
+    # The value following `name` on the command line, or None
+    if name in sys.argv[1:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return None
 
-        if player.lives > 0:
-            window.blit(hearts2x[player.lives], (WIDTH - 150, 20))
-        else:
-            window.blit(hearts2x[0], (WIDTH - 150, 20))
-            player.die()    
-        window.blit(cursor_image, (mouse_x, mouse_y))
-
-        if ((player.rect.right - offset_x >= WIDTH - scroll_area_width) and player.x_v > 0) or (
-            (player.rect.left - offset_x <= scroll_area_width) and player.x_v < 0):
-            offset_x += player.x_v
-            
-        if (player.rect.top - offset_y) <= scroll_area_height and player.y_v < 0:
-            offset_y += player.y_v
-        elif (player.rect.bottom - offset_y) >= (HEIGHT - scroll_area_height - player.height) and player.y_v > 0.7:
-            offset_y += player.y_v
-        
-        pygame.display.update()
 if __name__ == '__main__':
-    menu(WINDOW)
+    if '--replay' in sys.argv:
+        if not option('--replay'):
+            sys.exit('usage: python main.py --replay FILE')
+        headless(0, replay=option('--replay'))
+    elif '--headless' in sys.argv:
+        args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+        headless(int(args[0]) if args else 600)
+    else:
+        RECORDING = option('--record')
+        PLAYERS = min(int(option('--players') or PLAYERS), len(PLAYER_CONTROLS))
+        AGENTS = int(option('--agents') or AGENTS)
+        main()
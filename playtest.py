@@ -0,0 +1,400 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+# Playtests always run without a window or sound card
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import numpy as np
+import pygame
+from main import (CHARACTERS, Character, CharacterSystem, Fire, Goal, LevelData, Player, TileMap, HEIGHT,
+                  PLAYER_SPEED, character_sprites, get_mask, init_display)
+from benchmark import BLOCK_SIZE, generate_level
+
+# The search plays short input macros from every spot the player can stand
+# on, breadth first, so the first time a spot is reached it is reached with
+# the fewest macros. Macros run on a CharacterSystem, which moves bodies
+# exactly like Player and move_player() do.
+NODE_GRID = 16  # landing spots closer than this horizontally (at the same height) count as one
+MAX_STEPS = 300  # a macro that hasn't landed after this many steps is dropped
+MAX_DEPTH = 40  # macros in the longest path searched
+WALK_STEPS = 8
+# How damage is modelled, for the report
+DAMAGE_MODEL = ("Any contact with fire ends a macro. Contact is tested like handle_move() does: the mask of "
+                "the frame the player shows, where it is and 2 * PLAYER_SPEED to either side. A fire counts "
+                "with every frame it may show, so its animation can't hide it. Fires are solid in the game, "
+                "but only for a player already touching them, so that doesn't change paths without damage. "
+                "The invulnerability after a hit is not used.")
+
+
+def build_macros():
+    # (name, direction, steps the direction is held, jump step, double jump step, shortest length);
+    # -1 means no (double) jump
+    macros = []
+    for direction, name in ((-1, 'left'), (1, 'right')):
+        macros.append((f'walk {name}', direction, WALK_STEPS, -1, -1, WALK_STEPS))
+    for direction, name in ((-1, 'left'), (0, 'up'), (1, 'right')):
+        for double in (-1, 6, 12, 18, 24, 30):
+            for hold in ((MAX_STEPS, 10) if direction else (MAX_STEPS,)):
+                label = f'jump {name}'
+                if double >= 0:
+                    label += f', double jump after {double}'
+                if hold < MAX_STEPS:
+                    label += f', let go after {hold}'
+                macros.append((label, direction, hold, 0, double, 1))
+    return macros
+
+MACROS = build_macros()
+
+
+def damage_area():
+    # Box around every pixel the game may test against fire: the player's
+    # animations (the hit animation only plays once it has been hurt),
+    # widened by the probes handle_move() makes on each side
+    rects = [rect for name, frames in character_sprites(CHARACTERS[0]).items()
+             if not name.startswith(('hit', 'wall_jump')) for frame in frames
+             for rect in get_mask(frame).get_bounding_rects()]
+    return rects[0].unionall(rects[1:]).inflate(PLAYER_SPEED * 2 * 2, 0)
+
+
+class Hazards:
+    # Fire rects merged per tile cell, so a box no bigger than a cell is
+    # only tested against the (at most four) cells its corners are in. The fires of a cell are
+    # merged into their bounding box, which for the fire rows levels use is
+    # the fires themselves. touching() is that quick test for many boxes at
+    # once, hurts() the exact one for a single body.
+    def __init__(self, fires, bounds, size):
+        self.size, self.left, self.top = size, bounds.left, bounds.top
+        self.box = np.zeros((4, bounds.height // size + 2, bounds.width // size + 2), np.int64)  # left, top, right, bottom
+        self.fires = fires  # (rect, mask)
+        self.cells = {}  # (col, row) -> indices of the fires in it
+        for index, (rect, _) in enumerate(fires):
+            for col in range((rect.left - self.left) // size, (rect.right - 1 - self.left) // size + 1):
+                for row in range((rect.top - self.top) // size, (rect.bottom - 1 - self.top) // size + 1):
+                    self.cells.setdefault((col, row), []).append(index)
+                    cell = pygame.Rect(self.left + col * size, self.top + row * size, size, size)
+                    box = self.box[:, row, col]
+                    if box[2] > box[0]:
+                        cell = cell.clip(rect).union(pygame.Rect(box[0], box[1], box[2] - box[0], box[3] - box[1]))
+                    else:
+                        cell = cell.clip(rect)
+                    box[:] = cell.left, cell.top, cell.right, cell.bottom
+
+    def touching(self, left, top, width, height):
+        hit = np.zeros(len(left), bool)
+        _, rows, cols = self.box.shape
+        for x in (left, left + width - 1):
+            for y in (top, top + height - 1):
+                col, row = (x - self.left) // self.size, (y - self.top) // self.size
+                inside = (col >= 0) & (col < cols) & (row >= 0) & (row < rows)
+                box = self.box[:, np.where(inside, row, 0), np.where(inside, col, 0)]
+                hit |= inside & (box[2] > box[0]) & (left < box[2]) & (left + width > box[0]) & (
+                    top < box[3]) & (top + height > box[1])
+        return hit
+
+    def hurts(self, mask, x, y):
+        # Whether a body showing `mask` at (x, y) takes damage, tested like
+        # handle_move(): where it is and PLAYER_SPEED * 2 to either side
+        area = pygame.Rect(x, y, *mask.get_size()).inflate(PLAYER_SPEED * 2 * 2, 0)
+        near = set()
+        for col in range((area.left - self.left) // self.size, (area.right - 1 - self.left) // self.size + 1):
+            for row in range((area.top - self.top) // self.size, (area.bottom - 1 - self.top) // self.size + 1):
+                near.update(self.cells.get((col, row), ()))
+        for index in sorted(near):
+            rect, fire = self.fires[index]
+            for dx in (0, -PLAYER_SPEED * 2, PLAYER_SPEED * 2):
+                if mask.overlap(fire, (rect.x - x - dx, rect.y - y)):
+                    return True
+        return False
+
+
+class PlaytestLevel:
+    # What the search needs from a level: its terrain as a TileMap, fire
+    # and goal rects, the area it spans, where the player starts and the
+    # part of the player's frame fire hurts
+    def __init__(self, spec):
+        init_display()
+        if spec[0] == 'file':
+            data = LevelData.load(spec[1])
+            objects = data.build(0, data.columns)
+            self.name = data.name or os.path.splitext(os.path.basename(spec[1]))[0]
+            self.bounds, self.start, self.size = data.bounds(), tuple(data.start), data.tile_size
+        else:
+            blocks, fires, seed = spec[1:]
+            objects = generate_level(blocks, fires, seed)
+            area = objects[0].rect.unionall([obj.rect for obj in objects])
+            self.name = f'generated_{blocks}_{seed}'
+            self.bounds = pygame.Rect(area.left, area.top - HEIGHT, area.width, area.height + HEIGHT)
+            self.start, self.size = (100, 100), BLOCK_SIZE
+        self.tiles = TileMap(self.size)
+        self.fires, self.goals = [], []
+        fire_masks, masks = {}, []  # sprite sheets -> every frame's mask drawn into one
+        for obj in objects:
+            if isinstance(obj, Fire):
+                self.fires.append(obj.rect)
+                if id(obj.fire) not in fire_masks:
+                    mask = fire_masks[id(obj.fire)] = pygame.mask.Mask(obj.rect.size)
+                    for frame in (frame for frames in obj.fire.values() for frame in frames):
+                        mask.draw(get_mask(frame), (0, 0))
+                masks.append(fire_masks[id(obj.fire)])
+            elif isinstance(obj, Goal):
+                self.goals.append(obj.rect)
+            elif self.tiles.handles(obj):
+                self.tiles.add(obj.rect)
+        self.hazards = Hazards(list(zip(self.fires, masks)), self.bounds, self.size)
+        self.damage = damage_area()
+
+    def platforms(self):
+        # (col, row) of every solid tile with open space above it; tiles
+        # with fire on them are hazards rather than somewhere to stand. So
+        # are the tops of walls bounding the level from top to bottom, and
+        # tiles left of x = 0, which handle_move() never lets the player pass.
+        solid = self.tiles.solid > 0
+        top = solid & ~np.vstack([np.zeros((1, solid.shape[1]), bool), solid[:-1]])
+        rows, cols = np.flatnonzero(solid.any(axis=1)), np.flatnonzero(solid.any(axis=0))
+        if len(cols):
+            for edge in (cols[0], cols[-1]):
+                if solid[rows[0]:rows[-1] + 1, edge].all():
+                    top[:, edge] = False
+        rows, cols = np.nonzero(top)
+        platforms = set(zip((cols + self.tiles.first_col).tolist(), (rows + self.tiles.first_row).tolist()))
+        ox, oy = self.tiles.offset
+        return {(col, row) for col, row in platforms if ox + (col + 1) * self.size > 0} - {
+            ((rect.centerx - ox) // self.size, (rect.centery - oy) // self.size + 1) for rect in self.fires}
+
+
+LEVEL = None  # the PlaytestLevel of a worker process
+
+
+def init_worker(spec):
+    global LEVEL
+    LEVEL = PlaytestLevel(spec)
+
+
+def play_macros(starts):
+    # Plays every macro from every (x, y) in `starts` at once. Returns the
+    # landings as (start, macro, x, y), the starts and macros that touched
+    # a goal, and the tile cells the hitboxes passed through.
+    level = LEVEL
+    system = CharacterSystem(level.tiles, capacity=max(len(starts) * len(MACROS), 1))
+    for x, y in starts:
+        for _ in MACROS:
+            system.add(Character(CHARACTERS[0]), x, y)
+    count = len(system)
+    macro = np.tile(np.arange(len(MACROS)), len(starts))
+    direction, hold, jump_at, double_at, shortest = (np.array([m[i] for m in MACROS])[macro] for i in range(1, 6))
+    hitbox, damage = Player.hitbox_area(), level.damage
+    size, (ox, oy) = level.tiles.tile_size, level.tiles.offset
+    done = np.zeros(count, bool)
+    landings, goals, cells = [], set(), []
+
+    for step in range(MAX_STEPS):
+        system.walk[:count] = np.where(step < hold, direction, 0)
+        system.jumps[:count][(jump_at == step) | (double_at == step)] = 1
+        right = system.right[:count].copy()  # bodies face where they did before the step until it's over
+        system.step()
+        x, y = system.x[:count], system.y[:count]
+        left, top = x + hitbox.x, y + hitbox.y
+        moving = np.flatnonzero(~done)
+        for cx in (left[moving], left[moving] + hitbox.width - 1):
+            for cy in (top[moving], top[moving] + hitbox.height - 1):
+                cells.append(np.stack([(cx - ox) // size, (cy - oy) // size], axis=1))
+
+        for rect in level.goals:
+            touched = ~done & (left < rect.right) & (left + hitbox.width > rect.left) & (
+                top < rect.bottom) & (top + hitbox.height > rect.top)
+            goals.update((int(slot) // len(MACROS), int(macro[slot])) for slot in np.flatnonzero(touched))
+        # Touching fire costs a life, so paths through fire don't count. The
+        # few bodies whose box is near a fire are tested with their masks.
+        hurt = ~done & level.hazards.touching(x + damage.x, y + damage.y, damage.width, damage.height)
+        for slot in np.flatnonzero(hurt).tolist():
+            frames = system.sheets[system.sheet[slot]][system.animation[slot]][right[slot]]
+            mask = get_mask(frames[system.shown[slot] // Player.ANIMATION_DELAY % len(frames)])
+            hurt[slot] = level.hazards.hurts(mask, int(x[slot]), int(y[slot]))
+        done |= hurt | (y > level.bounds.bottom)
+        _, grounded = level.tiles.sweep_many(left, top, hitbox.width, hitbox.height, np.ones(count, np.int64), 1)
+        landed = ~done & grounded & (system.y_v[:count] >= 0) & (step + 1 >= shortest)
+        for slot in np.flatnonzero(landed).tolist():
+            landings.append((slot // len(MACROS), int(macro[slot]), int(x[slot]), int(y[slot])))
+        done |= landed
+        if done.all():
+            break
+
+    cells = np.unique(np.concatenate(cells), axis=0) if cells else np.zeros((0, 2), np.int64)
+    return landings, sorted(goals), cells.tolist()
+
+
+def search(spec, workers, max_depth=MAX_DEPTH):
+    # Breadth-first search over macros from the level start; each layer of
+    # landing spots is split across the worker processes
+    level = PlaytestLevel(spec)
+    nodes = [(level.start, None, None)]  # (position, parent node, macro)
+    seen = {(level.start[0] // NODE_GRID, level.start[1])}
+    depth_of = [0]
+    cells = {}  # cell -> fewest macros to get there
+    goal = None  # (node, macro) first touching a goal
+    frontier = [0]
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(workers, init_worker, (spec,))
+    else:
+        init_worker(spec)
+    try:
+        for depth in range(1, max_depth + 1):
+            if not frontier:
+                break
+            size = max(8, -(-len(frontier) // (workers * 4)))
+            chunks = [frontier[i:i + size] for i in range(0, len(frontier), size)]
+            starts = [[nodes[node][0] for node in chunk] for chunk in chunks]
+            results = pool.map(play_macros, starts) if pool else [play_macros(chunk) for chunk in starts]
+            # Landings are taken in (start node, macro) order, so the paths
+            # found don't depend on how the layer was split between workers
+            landings, goals = [], []
+            for chunk, (chunk_landings, chunk_goals, visited) in zip(chunks, results):
+                for cell in map(tuple, visited):
+                    cells.setdefault(cell, depth)
+                goals += [(chunk[start], macro) for start, macro in chunk_goals]
+                landings += [(chunk[start], macro, x, y) for start, macro, x, y in chunk_landings]
+            if goals and goal is None:
+                goal = min(goals)
+            frontier = []
+            for start, macro, x, y in sorted(landings):
+                key = (x // NODE_GRID, y)
+                if key not in seen:
+                    seen.add(key)
+                    nodes.append(((x, y), start, macro))
+                    depth_of.append(depth)
+                    frontier.append(len(nodes) - 1)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return level, nodes, depth_of, cells, goal, bool(frontier)
+
+
+def path_to(nodes, node, last_macro=None):
+    # Macro names from the start to `node` (and then `last_macro`)
+    names = [] if last_macro is None else [MACROS[last_macro][0]]
+    while nodes[node][1] is not None:
+        names.append(MACROS[nodes[node][2]][0])
+        node = nodes[node][1]
+    return names[::-1]
+
+
+def analyse(level, nodes, depth_of, cells, goal, truncated):
+    hitbox = Player.hitbox_area()
+    size, (ox, oy) = level.tiles.tile_size, level.tiles.offset
+    platforms = level.platforms()
+    standing = {}  # platform -> node standing on it with the fewest macros
+    for node, ((x, y), _, _) in enumerate(nodes):
+        row = (y + hitbox.bottom - oy) // size
+        for col in range((x + hitbox.left - ox) // size, (x + hitbox.right - 1 - ox) // size + 1):
+            if (col, row) in platforms and (col, row) not in standing:
+                standing[(col, row)] = node
+    unreachable = sorted(platforms - set(standing))
+    highest = min(standing, key=lambda cell: (cell[1], cell[0]), default=None)
+    report = {
+        'level': level.name,
+        'landing_spots': len(nodes),
+        'reachable_cells': len(cells),
+        'platforms': len(platforms),
+        'reachable_platforms': len(standing),
+        'unreachable_platforms': [list(cell) for cell in unreachable],
+        'max_depth': max(depth_of),
+        'truncated': truncated,  # stopped at the depth limit with spots left to explore
+        'damage_model': DAMAGE_MODEL,
+        'highest_platform': highest and {'tile': list(highest), 'path': path_to(nodes, standing[highest])},
+    }
+    if level.goals:
+        report['goal'] = {'path': path_to(nodes, *goal)} if goal else None
+    return report, standing, unreachable
+
+
+def heatmap(level, cells, standing, unreachable, path, scale=8):
+    # One square per tile of the level's bounds: terrain grey, cells the
+    # player's hitbox got to from yellow (few macros) to blue (many),
+    # platforms it stood on green, platforms it never reached red and a dot
+    # where there is fire
+    size, (ox, oy) = level.size, level.tiles.offset
+    first_col, first_row = (level.bounds.left - ox) // size, (level.bounds.top - oy) // size
+    surface = pygame.Surface(((level.bounds.width // size + 1) * scale, (level.bounds.height // size + 1) * scale))
+    surface.fill((20, 20, 30))
+
+    def fill(col, row, color, inset=0):
+        surface.fill(color, ((col - first_col) * scale + inset, (row - first_row) * scale + inset,
+                             scale - inset * 2, scale - inset * 2))
+
+    deepest = max(cells.values(), default=1)
+    for (col, row), depth in cells.items():
+        t = depth / deepest
+        fill(col, row, (int(255 * (1 - t)), int(220 * (1 - t) + 60 * t), int(40 + 215 * t)))
+    rows, cols = np.nonzero(level.tiles.solid)
+    for col, row in zip((cols + level.tiles.first_col).tolist(), (rows + level.tiles.first_row).tolist()):
+        fill(col, row, (110, 110, 110))
+    for col, row in standing:
+        fill(col, row, (60, 200, 80))
+    for col, row in unreachable:
+        fill(col, row, (220, 40, 40))
+    for rect in level.fires:
+        fill((rect.centerx - ox) // size, (rect.centery - oy) // size, (255, 140, 0), scale // 4)
+    pygame.image.save(surface, path)
+
+
+def main_playtest():
+    parser = argparse.ArgumentParser(description='Headless reachability playtests of levels')
+    parser.add_argument('levels', nargs='*', help='level files (default: every file in levels/)')
+    parser.add_argument('--generated', type=int, nargs='+', default=[], metavar='BLOCKS',
+                        help='also test benchmark.generate_level() with this many blocks')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated levels')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-depth', type=int, default=MAX_DEPTH, help='longest path searched, in macros')
+    parser.add_argument('--output', default='playtest', help='directory for the heatmaps and the JSON report')
+    args = parser.parse_args()
+
+    specs = [('file', path) for path in args.levels]
+    specs += [('generated', blocks, blocks // 10, args.seed) for blocks in args.generated]
+    if not specs:
+        specs = [('file', os.path.join('levels', name)) for name in sorted(os.listdir('levels'))
+                 if name.endswith('.json')]
+    os.makedirs(args.output, exist_ok=True)
+
+    reports, failed = [], False
+    for spec in specs:
+        start = time.perf_counter()
+        level, nodes, depth_of, cells, goal, truncated = search(spec, args.workers, args.max_depth)
+        report, standing, unreachable = analyse(level, nodes, depth_of, cells, goal, truncated)
+        report['seconds'] = time.perf_counter() - start
+        image = os.path.join(args.output, f"{report['level'].replace(' ', '_').lower()}.png")
+        heatmap(level, cells, standing, unreachable, image)
+        reports.append(report)
+
+        print(f"{report['level']}: {report['reachable_platforms']}/{report['platforms']} platforms reachable, "
+              f"{report['reachable_cells']} cells, {report['landing_spots']} landing spots "
+              f"in {report['seconds']:.1f}s -> {image}")
+        if truncated:
+            print(f'  stopped at --max-depth {args.max_depth}, platforms further away count as unreachable')
+        for col, row in unreachable:
+            print(f'  unreachable platform at tile ({col}, {row})')
+        if report['highest_platform']:
+            highest = report['highest_platform']
+            print(f"  highest platform {tuple(highest['tile'])} in {len(highest['path'])} macros: "
+                  + '; '.join(highest['path']))
+        if 'goal' in report:
+            if report['goal']:
+                print(f"  goal in {len(report['goal']['path'])} macros: " + '; '.join(report['goal']['path']))
+            else:
+                print('  GOAL UNREACHABLE')
+                failed = True
+
+    with open(os.path.join(args.output, 'report.json'), 'w') as file:
+        json.dump(reports, file, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_playtest()